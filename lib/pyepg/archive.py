@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# pyepg/archive.py - HTTP traffic record/replay
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Record every HTTP request/response made during a run into a single archive
+file, and replay a run from that archive without any network access.
+
+File layout:
+
+  magic
+  record*   : keylen (u32), datalen (u32), key, zlib(marshal(response))
+  index     : zlib(marshal({ key : [ offset, ... ] }))
+  trailer   : index offset (u64), index magic
+
+If the index is missing (recording was interrupted) it is rebuilt by
+scanning the record headers.
+
+Details of the run (such as the grab period, which the schedule requests
+depend on) are stored as records keyed '#meta <name>', so that a replay
+can make the same requests.
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, re, time, zlib, marshal, struct, atexit, urllib2
+from threading import Lock
+
+# PyEPG
+import pyepg.log   as log
+import pyepg.stats as stats
+
+# ###########################################################################
+# Config/State
+# ###########################################################################
+
+ARCHIVE_MAGIC = 'PYEPGARC 1\n'
+INDEX_MAGIC   = 'PYEPGIDX'
+RECORD_HEAD   = struct.Struct('>II')
+TRAILER       = struct.Struct('>Q8s')
+META_PREFIX   = '#meta '
+
+# Request not in archive (replay), there's no point retrying
+class ArchiveMissing ( urllib2.URLError ):
+  pass
+
+# ###########################################################################
+# Archive
+# ###########################################################################
+
+class Archive:
+
+  def __init__ ( self, path, mode ):
+    self.path   = path
+    self.mode   = mode
+    self._lock  = Lock()
+    self._index = {}
+    self._next  = {}
+    if mode == 'record':
+      self._fp = open(path, 'wb')
+      self._fp.write(ARCHIVE_MAGIC)
+    else:
+      self._fp = open(path, 'rb')
+      self._load()
+
+  # Request key (API keys are not significant, nor stored)
+  @staticmethod
+  def key ( method, url ):
+    url = re.sub('([?&])apiKey=[^&]*&?', '\\1', url).rstrip('?&')
+    return '%s %s' % (method, url)
+
+  # Load index
+  def _load ( self ):
+    fp = self._fp
+    if fp.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+      raise Exception('%s is not a PyEPG archive' % self.path)
+
+    # Trailer
+    fp.seek(0, os.SEEK_END)
+    end = fp.tell()
+    if end >= TRAILER.size + len(ARCHIVE_MAGIC):
+      fp.seek(end - TRAILER.size)
+      (off, magic) = TRAILER.unpack(fp.read(TRAILER.size))
+      if magic == INDEX_MAGIC:
+        fp.seek(off)
+        self._index = marshal.loads(zlib.decompress(fp.read(end - TRAILER.size - off)))
+        return
+
+    # Rebuild
+    log.warn('archive - %s has no index, scanning' % self.path)
+    off = len(ARCHIVE_MAGIC)
+    while off + RECORD_HEAD.size <= end:
+      fp.seek(off)
+      (kl, dl) = RECORD_HEAD.unpack(fp.read(RECORD_HEAD.size))
+      if off + RECORD_HEAD.size + kl + dl > end: break
+      k = fp.read(kl)
+      self._index.setdefault(k, []).append(off)
+      off = off + RECORD_HEAD.size + kl + dl
+
+  # Write record
+  def _write ( self, k, r ):
+    d = zlib.compress(marshal.dumps(r))
+    with self._lock:
+      off = self._fp.tell()
+      self._fp.write(RECORD_HEAD.pack(len(k), len(d)))
+      self._fp.write(k)
+      self._fp.write(d)
+      self._index.setdefault(k, []).append(off)
+
+  # Read record (lock must be held)
+  def _read ( self, off ):
+    self._fp.seek(off)
+    (kl, dl) = RECORD_HEAD.unpack(self._fp.read(RECORD_HEAD.size))
+    self._fp.seek(kl, os.SEEK_CUR)
+    return marshal.loads(zlib.decompress(self._fp.read(dl)))
+
+  # Store response
+  def record ( self, method, url, status, head, body, elapsed, error = None ):
+    r = { 'status' : status, 'headers' : dict(head or {}), 'body' : body or '',
+          'time'   : elapsed }
+    if error: r['error'] = error
+    self._write(self.key(method, url), r)
+    stats.inc('archive_recorded')
+
+  # Store run detail (must be marshal-able)
+  def set_meta ( self, name, value ):
+    self._write(META_PREFIX + name, value)
+
+  # Get run detail (the last stored)
+  def get_meta ( self, name, default = None ):
+    with self._lock:
+      offs = self._index.get(META_PREFIX + name)
+      if not offs: return default
+      return self._read(offs[-1])
+
+  # Get next response for request (repeated requests are returned in the
+  # order they were recorded, the last is then re-used)
+  def replay ( self, method, url ):
+    k = self.key(method, url)
+    with self._lock:
+      offs = self._index.get(k)
+      if not offs:
+        stats.inc('archive_missing')
+        return None
+      i = self._next.get(k, 0)
+      self._next[k] = min(i + 1, len(offs) - 1)
+      ret = self._read(offs[i])
+    stats.inc('archive_replayed')
+    return ret
+
+  # Finish (write index)
+  def close ( self ):
+    with self._lock:
+      if self._fp is None: return
+      if self.mode == 'record':
+        off = self._fp.tell()
+        self._fp.write(zlib.compress(marshal.dumps(self._index)))
+        self._fp.write(TRAILER.pack(off, INDEX_MAGIC))
+        log.debug('archive - %d requests written to %s'\
+                  % (len(self._index), self.path), 0)
+      self._fp.close()
+      self._fp = None
+
+# ###########################################################################
+# API
+# ###########################################################################
+
+ARCHIVE = None
+
+# Open archive (mode is record or replay)
+def init ( path, mode ):
+  global ARCHIVE
+  if mode not in [ 'record', 'replay' ]:
+    raise Exception('invalid archive mode %s' % mode)
+  ARCHIVE = Archive(path, mode)
+  atexit.register(close)
+  log.info('archive - %s %s' % (mode, path))
+
+# Close archive
+def close ():
+  if ARCHIVE: ARCHIVE.close()
+
+# Archive in use (record or replay)
+def active ():
+  return ARCHIVE is not None
+
+# Recording
+def recording ():
+  return ARCHIVE is not None and ARCHIVE.mode == 'record'
+
+# Replaying
+def replaying ():
+  return ARCHIVE is not None and ARCHIVE.mode == 'replay'
+
+# Record response
+def record ( method, url, status, head, body, elapsed, error = None ):
+  if recording():
+    ARCHIVE.record(method, url, status, head, body, elapsed, error)
+
+# Replay response (None if not in archive)
+def replay ( method, url ):
+  return ARCHIVE.replay(method, url)
+
+# Store run detail (when recording)
+def set_meta ( name, value ):
+  if recording():
+    ARCHIVE.set_meta(name, value)
+
+# Get recorded run detail (when replaying)
+def get_meta ( name, default = None ):
+  if not replaying(): return default
+  return ARCHIVE.get_meta(name, default)
+
+# ###########################################################################
+# Editor
+# ###########################################################################
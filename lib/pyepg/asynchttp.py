@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+#
+# pyepg/asynchttp.py - Event driven HTTP client
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Minimal asyncore based HTTP/1.1 client, a single thread can drive a large
+number of outstanding requests over a pool of persistent (and optionally
+pipelined) connections to one host
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import asyncore, socket, time, heapq, urlparse
+from collections import deque
+
+# PyEPG
+import pyepg.log   as log
+import pyepg.stats as stats
+
+# ###########################################################################
+# Config/State
+# ###########################################################################
+
+USER_AGENT = 'PyEPG URL Fetcher/Cacher'
+
+# Number of times a request can be silently re-sent because the server
+# closed a keep-alive connection before responding
+MAX_RESETS = 3
+
+# Delay before opening another connection after one fails to connect
+# (doubled for each consecutive failure, up to the cap)
+CONNECT_BACKOFF     = 0.5
+CONNECT_BACKOFF_CAP = 30.0
+
+# ###########################################################################
+# Request/Response
+# ###########################################################################
+
+class Request:
+
+  def __init__ ( self, url, callback, headers = None, ctx = None ):
+    urlp          = urlparse.urlparse(url)
+    self.url      = url
+    self.path     = urlp.path or '/'
+    if urlp.query: self.path = self.path + '?' + urlp.query
+    self.callback = callback
+    self.headers  = headers or {}
+    self.ctx      = ctx
+    self.attempt  = 0
+    self.resets   = 0
+    self.sent     = None
+
+class Response:
+
+  def __init__ ( self ):
+    self.status  = None
+    self.reason  = None
+    self.version = None
+    self.headers = {}
+    self.body    = None
+
+#
+# Incremental HTTP response parser
+#
+# Note: only GET requests are made so the only responses without a body
+#       are 1xx, 204 and 304
+#
+class _Parser:
+
+  def __init__ ( self ):
+    self._buf   = ''
+    self._body  = []
+    self._need  = 0
+    self._state = 'head'
+    self._resp  = None
+    self.partial = False
+
+  # Add data, returns list of completed responses
+  def feed ( self, data ):
+    ret = []
+    self._buf = self._buf + data
+    if data: self.partial = True
+    while True:
+      r = self._step()
+      if r is None: break
+      if r is not True: ret.append(r)
+    return ret
+
+  # Connection closed, returns final response (if terminated by close)
+  def close ( self ):
+    ret = None
+    if self._state == 'close':
+      self._body.append(self._buf)
+      self._buf = ''
+      ret = self._complete()
+    return ret
+
+  # Complete current response
+  def _complete ( self ):
+    ret = self._resp
+    ret.body    = ''.join(self._body)
+    self._resp  = None
+    self._body  = []
+    self._state = 'head'
+    self.partial = len(self._buf) > 0
+    return ret
+
+  # Process next bit of state, None=need more data, True=continue
+  def _step ( self ):
+
+    # Headers
+    if self._state == 'head':
+      i = self._buf.find('\r\n\r\n')
+      if i == -1: return None
+      lines = self._buf[:i].split('\r\n')
+      self._buf = self._buf[i+4:]
+      r = Response()
+      p = lines[0].split(' ', 2)
+      r.version = p[0]
+      r.status  = int(p[1])
+      if len(p) > 2: r.reason = p[2]
+      for l in lines[1:]:
+        k, s, v = l.partition(':')
+        r.headers[k.strip().lower()] = v.strip()
+      self._resp = r
+
+      # Body type
+      if r.status < 200 or r.status in [ 204, 304 ]:
+        return self._complete()
+      elif 'chunked' in r.headers.get('transfer-encoding', '').lower():
+        self._state = 'chunk_size'
+      elif 'content-length' in r.headers:
+        self._state = 'body'
+        self._need  = int(r.headers['content-length'])
+      else:
+        self._state = 'close'
+      return True
+
+    # Fixed length body
+    elif self._state == 'body':
+      n = min(self._need, len(self._buf))
+      if n:
+        self._body.append(self._buf[:n])
+        self._buf  = self._buf[n:]
+        self._need = self._need - n
+      if self._need: return None
+      return self._complete()
+
+    # Chunk header
+    elif self._state == 'chunk_size':
+      i = self._buf.find('\r\n')
+      if i == -1: return None
+      n = int(self._buf[:i].split(';')[0].strip(), 16)
+      self._buf = self._buf[i+2:]
+      if n:
+        self._state = 'chunk_data'
+        self._need  = n
+      else:
+        self._state = 'chunk_trailer'
+      return True
+
+    # Chunk data (plus trailing CRLF)
+    elif self._state == 'chunk_data':
+      if len(self._buf) < self._need + 2: return None
+      self._body.append(self._buf[:self._need])
+      self._buf   = self._buf[self._need+2:]
+      self._state = 'chunk_size'
+      return True
+
+    # Chunk trailer
+    elif self._state == 'chunk_trailer':
+      i = self._buf.find('\r\n')
+      if i == -1: return None
+      l = self._buf[:i]
+      self._buf = self._buf[i+2:]
+      if not l: return self._complete()
+      return True
+
+    # Read until close
+    else:
+      return None
+
+# ###########################################################################
+# Connection
+# ###########################################################################
+
+class Connection ( asyncore.dispatcher ):
+
+  def __init__ ( self, client, idx ):
+    asyncore.dispatcher.__init__(self, map=client._map)
+    self._client  = client
+    self._idx     = idx
+    self._out     = ''
+    self._parser  = _Parser()
+    self._closing = False
+    self._active  = time.time()
+    self._created = self._active
+    self.pending  = deque()
+
+  # Start connecting (socket.error if that fails outright, e.g. DNS)
+  def open ( self ):
+    try:
+      self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.connect(self._client.addr)
+    except:
+      self.close()
+      raise
+    log.debug('asynchttp - conn %d connecting to %s'\
+              % (self._idx, self._client.host), 3)
+
+  # Can accept another request
+  def ready ( self ):
+    return not self._closing and\
+           len(self.pending) < self._client.pipeline
+
+  # Send request
+  def send_request ( self, req ):
+    h = { 'Host' : self._client.host, 'User-Agent' : USER_AGENT }
+    h.update(req.headers)
+    out = [ 'GET %s HTTP/1.1' % req.path ]
+    for k in h: out.append('%s: %s' % (k, h[k]))
+    self._out = self._out + '\r\n'.join(out) + '\r\n\r\n'
+    if not self.pending: self._active = time.time()
+    req.sent = time.time()
+    self.pending.append(req)
+
+  # Check for stalled connection (or request over the latency budget)
+  def check_timeout ( self, now ):
+    if not self.connected:
+      if (now - self._created) > self._client.connect_timeout:
+        log.debug('asynchttp - conn %d connect timeout' % self._idx, 1)
+        self._shutdown('connect timeout')
+    elif self.pending and (now - self._active) > self._client.timeout:
+      log.debug('asynchttp - conn %d timeout' % self._idx, 1)
+      self._shutdown('timeout')
+    elif self.pending and self._client.budget and\
+         (now - self.pending[0].sent) > self._client.budget:
+      log.debug('asynchttp - conn %d reaped' % self._idx, 1)
+      stats.inc('http_conn_reaped')
+      self._client.reaped = self._client.reaped + 1
+      self._shutdown('request exceeded latency budget')
+
+  def writable ( self ):
+    return not self.connected or len(self._out) > 0
+
+  def handle_connect ( self ):
+    log.debug('asynchttp - conn %d connected' % self._idx, 3)
+    self._client._fails = 0
+
+  def handle_write ( self ):
+    n = self.send(self._out)
+    self._out = self._out[n:]
+
+  def handle_read ( self ):
+    data = self.recv(65536)
+    if not data: return
+    self._active = time.time()
+    for r in self._parser.feed(data):
+      req = self.pending.popleft()
+      if r.headers.get('connection', '').lower() == 'close' or\
+         r.version == 'HTTP/1.0':
+        self._closing = True
+      self._client._complete(req, r, None)
+    if self._closing and not self._parser.partial:
+      self._shutdown(None)
+
+  def handle_close ( self ):
+    r = self._parser.close()
+    if r is not None and self.pending:
+      self._client._complete(self.pending.popleft(), r, None)
+      self._shutdown(None)
+    elif self._parser.partial:
+      self._shutdown('connection closed mid response')
+    else:
+      self._shutdown(None)
+
+  def handle_error ( self ):
+    t, v = asyncore.compact_traceback()[1:3]
+    self._shutdown('%s: %s' % (t, v))
+
+  # Close and re-queue outstanding work (first request fails on error)
+  def _shutdown ( self, err ):
+    self.close()
+    self._client._closed(self)
+    pending      = self.pending
+    self.pending = deque()
+    if pending and err:
+      self._client._complete(pending.popleft(), None, err)
+    self._client._requeue(pending)
+
+# ###########################################################################
+# Client
+# ###########################################################################
+
+class Client:
+
+  def __init__ ( self, host, port = 80, conns = 64, pipeline = 4,
+                 timeout = 60.0, connect_timeout = None, budget = None ):
+    self.host     = host
+    self.port     = port
+    if ':' in host:
+      (host, port) = host.split(':', 1)
+      self.port    = int(port)
+    self.addr     = (host, self.port)
+    self.conns    = max(1, conns)
+    self.pipeline = max(1, pipeline)
+    self.timeout  = timeout
+    self.connect_timeout = connect_timeout or timeout
+    self.budget   = budget
+    self.reaped   = 0
+    self._map     = {}
+    self._conns   = []
+    self._queue   = deque()
+    self._delayed = []
+    self._cidx    = 0
+    self._fails   = 0 # consecutive connect failures
+    self._hold    = 0 # no new connection until
+
+  # Queue a request (optionally delayed by N seconds)
+  def request ( self, req, delay = 0 ):
+    if delay > 0:
+      heapq.heappush(self._delayed, (time.time() + delay, id(req), req))
+    else:
+      self._queue.append(req)
+
+  # Number of requests not yet completed
+  def outstanding ( self ):
+    ret = len(self._queue) + len(self._delayed)
+    for c in self._conns: ret = ret + len(c.pending)
+    return ret
+
+  # Close all connections
+  def close ( self ):
+    for c in list(self._conns):
+      c.close()
+    self._conns = []
+
+  # Run one iteration of the event loop
+  def poll ( self, timeout = 0.5 ):
+    now = time.time()
+
+    # Release delayed requests
+    while self._delayed and self._delayed[0][0] <= now:
+      self._queue.append(heapq.heappop(self._delayed)[2])
+
+    # Timeouts
+    for c in list(self._conns):
+      c.check_timeout(now)
+
+    # Dispatch
+    self._dispatch()
+
+    # Wait for I/O (or the next delayed request/connection attempt)
+    wake = None
+    if self._delayed:
+      wake = self._delayed[0][0]
+    if self._queue and self._hold > now and (wake is None or self._hold < wake):
+      wake = self._hold
+    if wake is not None:
+      timeout = max(0, min(timeout, wake - now))
+    if self._map:
+      asyncore.loop(timeout=timeout, map=self._map, count=1)
+    elif wake is not None:
+      time.sleep(timeout)
+
+  # Assign queued requests to connections
+  def _dispatch ( self ):
+    while self._queue:
+      conn = None
+      for c in self._conns:
+        if c.ready() and (conn is None or len(c.pending) < len(conn.pending)):
+          conn = c
+      if conn is None or (conn.pending and len(self._conns) < self.conns):
+        if len(self._conns) < self.conns and time.time() >= self._hold:
+          c = Connection(self, self._cidx)
+          self._cidx = self._cidx + 1
+          try:
+            c.open()
+          except socket.error, e:
+            self._connect_failed(e)
+            continue
+          conn = c
+          self._conns.append(conn)
+      if conn is None: break
+      conn.send_request(self._queue.popleft())
+
+  # Connection attempt failed, no more are made for a while and the
+  # request (or, with no connections to serve them, all queued requests)
+  # fails
+  def _connect_failed ( self, e ):
+    log.debug('asynchttp - connect to %s failed [e=%s]' % (self.host, e), 1)
+    stats.inc('http_conn_failed')
+    self._fails = self._fails + 1
+    self._hold  = time.time() + min(CONNECT_BACKOFF_CAP,
+                                    CONNECT_BACKOFF * 2 ** (self._fails - 1))
+    if self._conns:
+      reqs = [ self._queue.popleft() ]
+    else:
+      reqs = list(self._queue)
+      self._queue.clear()
+    for req in reqs:
+      req.sent = time.time()
+      self._complete(req, None, 'connect failed: %s' % e)
+
+  # Request complete
+  def _complete ( self, req, resp, err ):
+    try:
+      req.callback(req, resp, err)
+    except Exception, e:
+      log.error('asynchttp - callback failed for %s [e=%s]' % (req.url, e))
+
+  # Re-queue unanswered requests (front of queue)
+  def _requeue ( self, reqs ):
+    for req in reversed(reqs):
+      req.resets = req.resets + 1
+      if req.resets > MAX_RESETS:
+        self._complete(req, None, 'too many connection resets')
+      else:
+        self._queue.appendleft(req)
+
+  # Connection closed
+  def _closed ( self, conn ):
+    self._conns = [ c for c in self._conns if c is not conn ]
+
+# ###########################################################################
+# Editor
+# ###########################################################################
@@ -24,12 +24,15 @@
 # ###########################################################################
 
 # System
-import os
+import os, errno
 import sqlite3 as sqlite
 
 # PyEPG
-import pyepg.conf as conf
-import pyepg.log  as log
+import pyepg.conf     as conf
+import pyepg.log      as log
+import pyepg.stats    as stats
+import pyepg.httppool as httppool
+import pyepg.archive  as archive
 
 # ###########################################################################
 # Config/State
@@ -47,6 +50,7 @@ CACHE_DB_DATA    = {
 }
 
 PYEPG_USER_AGENT = 'PyEPG URL Fetcher/Cacher'
+PYEPG_ENCODING   = 'gzip, deflate'
 
 # ###########################################################################
 # Cache API
@@ -209,7 +213,10 @@ def put_file ( name, data, imeta = {} ):
   # Store
   path = CACHE_PATH + os.path.sep + name
   if not os.path.exists(os.path.dirname(path)):
-    os.makedirs(os.path.dirname(path))
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError, e: # created by another thread
+      if e.errno != errno.EEXIST: raise
   open(path, 'w').write(data)
   open(path + '.meta', 'w').write(repr(meta))
   log.debug('cache: file %s stored' % name)
@@ -227,13 +234,150 @@ def touch_file ( name ):
 # URL fetching
 # ###########################################################################
 
+#
+# Read response body, decompressing as data arrives
+#
+# @param fp       File like object to read from (HTTP response)
+# @param encoding Content-Encoding of the response
+def _read_body ( fp, encoding ):
+  import zlib
+  enc = (encoding or '').strip().lower()
+  if enc not in [ 'gzip', 'x-gzip', 'deflate' ]:
+    return fp.read()
+
+  # Decompress
+  if enc == 'deflate': wbits = zlib.MAX_WBITS
+  else:                wbits = 16 + zlib.MAX_WBITS
+  dec = zlib.decompressobj(wbits)
+  ret = []
+  raw = 0
+  while True:
+    d = fp.read(65536)
+    if not d: break
+    try:
+      ret.append(dec.decompress(d))
+    except zlib.error:
+
+      # Some servers send raw deflate (no zlib header)
+      if enc != 'deflate' or raw: raise
+      dec = zlib.decompressobj(-zlib.MAX_WBITS)
+      ret.append(dec.decompress(d))
+    raw = raw + len(d)
+  ret.append(dec.flush())
+  ret = ''.join(ret)
+
+  # Stats
+  stats.inc('http_compressed_responses')
+  stats.inc('http_compressed_bytes_saved', len(ret) - raw)
+  return ret
+
+#
+# Decode already read response body
+#
+def decode_body ( data, encoding ):
+  from cStringIO import StringIO
+  return _read_body(StringIO(data), encoding)
+
+#
+# Perform HTTP request over a persistent connection
+#
+# The supplied connection is used, else one is taken from the shared pool.
+# Redirects are followed and error codes raised (as urllib2 would)
+#
+# @return (status, headers, body)
+def _http_fetch ( url, method = 'GET', conn = None, extra = {} ):
+  import httplib, socket, urllib2, urlparse
+  hdrs = { 'User-Agent' : PYEPG_USER_AGENT,
+           'Accept-Encoding' : PYEPG_ENCODING }
+  hdrs.update(extra)
+
+  # Follow redirects
+  for i in range(5):
+    urlp = urlparse.urlparse(url)
+    path = urlp.path or '/'
+    if urlp.query: path = path + '?' + urlp.query
+    own  = conn is None
+
+    # Send (a pooled keep-alive connection may have been dropped by the
+    # server since it was last checked, so allow one retry, but not if
+    # the server is just slow or the connection was reaped as stuck)
+    while True:
+      c = conn
+      if own: c = httppool.acquire(urlp.scheme, urlp.netloc)
+      try:
+        c.request(method, path, None, hdrs)
+        r    = c.getresponse()
+        if method == 'HEAD':
+          body = r.read()
+        else:
+          body = _read_body(r, r.getheader('content-encoding'))
+        break
+      except (httplib.HTTPException, socket.error), e:
+        if not own:
+          c.close()
+          raise
+        httppool.release(c, False)
+        if c._pyepg_reaped:
+          raise socket.timeout('request exceeded latency budget')
+        if not c._pyepg_reused or isinstance(e, socket.timeout): raise
+        stats.inc('http_conn_stale')
+
+    # Process
+    head = {}
+    for (k,v) in r.getheaders(): head[k.lower()] = v
+    if method != 'HEAD' and 'content-encoding' in head:
+      del head['content-encoding']
+    if own: httppool.release(c, not r.will_close)
+    if r.status in [ 301, 302, 303, 307 ] and 'location' in head:
+      log.debug('cache: redirect to %s' % head['location'], 3)
+      url  = urlparse.urljoin(url, head['location'])
+      conn = None
+      continue
+    if r.status >= 400:
+      raise urllib2.HTTPError(url, r.status, r.reason, head, None)
+    return (r.status, head, body)
+
+  raise urllib2.URLError('too many redirects')
+
+#
+# Perform HTTP request (recording to, or replaying from, the archive)
+#
+# @return (status, headers, body)
+def _http_request ( url, method = 'GET', conn = None, extra = {} ):
+  import time, urllib2
+  if archive.replaying():
+    r = archive.replay(method, url)
+    if r is None:
+      raise archive.ArchiveMissing('%s not in archive' % url)
+    if conf.get('http_archive_delay', False):
+      time.sleep(r['time'])
+    if 'error' in r:
+      raise urllib2.URLError(r['error'])
+    if r['status'] >= 400:
+      raise urllib2.HTTPError(url, r['status'], 'replay', r['headers'], None)
+    return (r['status'], r['headers'], r['body'])
+
+  # Fetch
+  t = time.time()
+  try:
+    (st, head, body) = _http_fetch(url, method, conn, extra)
+  except urllib2.HTTPError, e:
+    archive.record(method, url, e.code, e.hdrs, None, time.time() - t)
+    raise
+  except Exception, e:
+    archive.record(method, url, 0, None, None, time.time() - t, str(e))
+    raise
+  archive.record(method, url, st, head, body, time.time() - t)
+  return (st, head, body)
+
 #
 # Fetch a URL
 #
 # @param cache If True attempt to retrieve/store the data in the local cache
 # @param ttl   If local cache file is newer than ttl, don't bother to check
 #              remote object at all
-# @param conn  Persistent connection (created externally)
+# @param conn  Persistent connection (created externally), if not specified
+#              a connection from the shared pool is used
 def get_url ( url, cache = True, ttl = 0, conn = None ):
   import urllib2, urlparse
   log.debug('cache: get url %s' % url, 3)
@@ -244,12 +388,14 @@ def get_url ( url, cache = True, ttl = 0, conn = None ):
   path = urlp.netloc + os.path.sep + urlp.path[1:]
   http = urlp.scheme in [ 'http', 'https' ]
 
-  # Don't cache dynamic requests
+  # Don't cache dynamic requests (or when recording/replaying traffic)
   if urlp.params or urlp.query: cache = False
+  if archive.active(): cache = False
 
   # Create request
   req  = urllib2.Request(url)
   req.add_header('User-Agent', PYEPG_USER_AGENT)
+  req.add_header('Accept-Encoding', PYEPG_ENCODING)
 
   # Check cache
   if cache:
@@ -263,11 +409,8 @@ def get_url ( url, cache = True, ttl = 0, conn = None ):
         head = {}
 
         # Fetch remote headers
-        if http and conn:
-          log.debug('cache: use persistent connection', 5)
-          conn.request('GET', url, None, {'User-Agent':PYEPG_USER_AGENT})
-          h = conn.getresponse().getheaders()
-          for (k,v) in h: head[k.lower()] = v
+        if http:
+          (st, head, tmp) = _http_request(url, 'HEAD', conn)
         else:
           req.get_method = lambda: 'HEAD'
           up   = urllib2.urlopen(req, timeout=60.0)
@@ -290,17 +433,13 @@ def get_url ( url, cache = True, ttl = 0, conn = None ):
   if not ret:
     log.debug('cache: fetch remote', 1)
     head = {}
-    if http and conn:
-      log.debug('cache: use persistent connection', 5)
-      conn.request('GET', url, None, {'User-Agent':PYEPG_USER_AGENT})
-      r   = conn.getresponse()
-      for (k,v) in r.getheaders(): head[k.lower()] = v
-      ret = r.read()
+    if http:
+      (st, head, ret) = _http_request(url, 'GET', conn)
     else:
       req.get_method = lambda: 'GET'
       up   = urllib2.urlopen(req, timeout=60.0)
-      ret  = up.read()
-      head = up.headers
+      head = dict(up.headers)
+      ret  = _read_body(up, head.pop('content-encoding', None))
 
     # Store
     if cache:
@@ -308,6 +447,90 @@ def get_url ( url, cache = True, ttl = 0, conn = None ):
   
   return ret
 
+#
+# Cached responses for dynamic URLs
+#
+# get_url() won't cache requests with a query string, these functions allow
+# the caller to name the response (so that only the significant parts of
+# the request form the key). Within ttl the cached copy is used as is, after
+# that it is revalidated with a conditional GET.
+#
+
+# Lookup cached response
+#
+# @return (data, fresh, conditional request headers)
+#
+# Note: bypassed while recording/replaying, so the archive holds every
+#       response in full
+def url_cache_lookup ( name, ttl ):
+  if archive.active():
+    return (None, False, {})
+  (data, meta, ok, valid) = _get_file(name, ttl)
+  if data is None or not meta or not valid:
+    stats.inc('url_cache_miss')
+    return (None, False, {})
+  if ok:
+    stats.inc('url_cache_fresh')
+    return (data, True, {})
+  head = {}
+  if 'etag' in meta:
+    head['If-None-Match']     = meta['etag']
+  if 'last-modified' in meta:
+    head['If-Modified-Since'] = meta['last-modified']
+  return (data, False, head)
+
+# Update cached response
+#
+# @return data to use (the cached copy if unmodified)
+#
+# Note: failing to update the cache doesn't fail the request
+def url_cache_update ( name, status, head, body, data = None ):
+  ret = body
+  try:
+    if status == 304 and data is not None:
+      stats.inc('url_cache_revalidated')
+      ret = data
+      touch_file(name)
+    elif status == 200 and body and not archive.active():
+      meta = {}
+      for k in [ 'etag', 'last-modified' ]:
+        if k in head: meta[k] = head[k]
+      put_file(name, body, meta)
+  except (IOError, OSError), e:
+    log.warn('cache: failed to store %s [e=%s]' % (name, e))
+    stats.inc('url_cache_errors')
+  return ret
+
+# Remove cached response
+def url_cache_drop ( name ):
+  path = CACHE_PATH + os.path.sep + name
+  for p in [ path, path + '.meta' ]:
+    if os.path.exists(p): os.unlink(p)
+
+# Remove cached responses (under prefix) not used for age seconds
+def url_cache_prune ( prefix, age ):
+  import time
+  root = CACHE_PATH + os.path.sep + prefix
+  now  = time.time()
+  for (p, ds, fs) in os.walk(root):
+    for f in fs:
+      if f.endswith('.meta'): continue
+      path = os.path.join(p, f)
+      if (os.stat(path).st_mtime + age) < now:
+        log.debug('cache: prune %s' % path, 3)
+        for t in [ path, path + '.meta' ]:
+          if os.path.exists(t): os.unlink(t)
+
+#
+# Fetch a dynamic URL, using a named cache entry
+#
+def get_url_cached ( url, name, ttl, conn = None ):
+  log.debug('cache: get url %s [%s]' % (url, name), 3)
+  (data, fresh, head) = url_cache_lookup(name, ttl)
+  if fresh: return data
+  (st, h, body) = _http_request(url, 'GET', conn, head)
+  return url_cache_update(name, st, h, body, data)
+
 #
 # Get PyEPG hosted data
 #
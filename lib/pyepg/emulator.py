@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# pyepg/emulator.py - Local Atlas API stand-in
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Small HTTP server emulating the parts of the Atlas API used by
+pyepg.grabber.atlas (schedule.json and content.json), plus the PyEPG data
+files. Responses are either synthetic (deterministic, with configurable
+size) or served from a recorded archive (see pyepg.archive).
+
+API responses can be subjected to injected faults (see FAULT_PROFILES) to
+reproduce a partially degraded service.
+
+Intended for benchmarking/testing the grab pipeline, not production use.
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, json, zlib, urlparse, random, socket, struct
+import BaseHTTPServer, SocketServer
+from threading import Thread, Lock
+
+# PyEPG
+import pyepg.archive as archive
+
+# ###########################################################################
+# Synthetic data
+# ###########################################################################
+
+WORDS = ( 'the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+          'news', 'drama', 'series', 'episode', 'weather', 'film', 'live' )
+
+GENRES = [ 'http://ref.atlasapi.org/genres/atlas/drama',
+           'http://ref.atlasapi.org/genres/atlas/news',
+           'http://ref.atlasapi.org/genres/atlas/factual',
+           'http://pressassociation.com/genres/1000',
+           'http://ref.atlasapi.org/genres/atlas/comedy' ]
+
+# Atlas time format
+def _time ( t ):
+  return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+# Deterministic text of roughly size bytes
+def _text ( seed, size ):
+  ret = []
+  n   = 0
+  while n < size:
+    w   = WORDS[seed % len(WORDS)]
+    ret.append(w)
+    n    = n + len(w) + 1
+    seed = (seed * 1103515245 + 12345) & 0x7fffffff
+  return ' '.join(ret)
+
+# Schedule entry
+def _item ( cid, pub, t, plen, payload ):
+  h   = zlib.crc32('%s:%d' % (cid, t)) & 0x7fffffff
+  num = (t // plen) % 50
+  ret = {
+    'uri'            : 'http://emulator/%s/episodes/%s/%d' % (pub, cid, t),
+    'type'           : 'episode',
+    'title'          : 'Programme %d' % num,
+    'description'    : _text(h, payload),
+    'publisher'      : { 'key' : pub },
+    'episode_number' : num % 12 + 1,
+    'genres'         : [ GENRES[h % len(GENRES)] ],
+    'container'      : { 'uri' : 'http://emulator/brands/%d' % (num % 25) },
+    'series_summary' : { 'uri'   : 'http://emulator/series/%d' % (num % 25),
+                         'title' : 'Series %d' % (num % 5 + 1) },
+    'people'         : [],
+    'broadcasts'     : [ {
+      'transmission_time'     : _time(t),
+      'transmission_end_time' : _time(t + plen),
+      'repeat'                : bool(h & 1),
+      'subtitled'             : True,
+      'signed'                : False,
+      'audio_described'       : bool(h & 4),
+      'widescreen'            : True,
+      'high_definition'       : bool(h & 2),
+    } ],
+  }
+  for i in range(h % 4):
+    ret['people'].append({ 'uri'       : 'http://emulator/people/%d' % (h + i),
+                           'name'      : 'Person %d' % (h % 1000 + i),
+                           'role'      : 'actor',
+                           'character' : 'Character %d' % i })
+  return ret
+
+# Schedule response
+def schedule ( cid, pub, tf, tt, plen = 1800, payload = 256 ):
+  items = []
+  t     = tf - (tf % plen)
+  while t < tt:
+    items.append(_item(cid, pub, t, plen, payload))
+    t = t + plen
+  return { 'schedule' : [ { 'channel_key' : cid, 'items' : items } ] }
+
+# Content response
+def content ( uris ):
+  ret = []
+  for u in uris:
+    if '/brands/' in u:
+      ret.append({ 'uri' : u, 'type' : 'brand',
+                   'title' : 'Brand %s' % u.split('/')[-1],
+                   'description' : _text(len(u), 64),
+                   'genres' : [ GENRES[0] ] })
+    elif '/series/' in u:
+      ret.append({ 'uri' : u, 'type' : 'series',
+                   'title' : 'Series %s' % u.split('/')[-1],
+                   'series_number' : 1 })
+  return { 'contents' : ret }
+
+# ###########################################################################
+# Faults
+# ###########################################################################
+
+#
+# Fault profiles, comma separated list of fault=args where
+#
+#   slow=P:S      P fraction of responses delayed by S seconds
+#   hang=P:S      P fraction of requests never answered (socket held S secs)
+#   truncate=P    P fraction of responses have truncated JSON
+#   burst=T:D     all requests fail (503) for D seconds in every T
+#   reset=P       P fraction of connections reset (no response)
+#
+FAULT_PROFILES = {
+  'none'     : '',
+  'slow'     : 'slow=0.2:3.0',
+  'hang'     : 'hang=0.01:3600',
+  'truncate' : 'truncate=0.05',
+  'burst'    : 'burst=30:5',
+  'reset'    : 'reset=0.05',
+  'degraded' : 'slow=0.1:2.0,hang=0.005:3600,truncate=0.02,burst=60:5,'
+               'reset=0.02',
+}
+
+# Parse fault profile (name or spec)
+def parse_faults ( spec ):
+  ret  = {}
+  spec = FAULT_PROFILES.get(spec, spec) or ''
+  for f in spec.split(','):
+    if not f: continue
+    (k, s, v) = f.partition('=')
+    ret[k.strip()] = map(float, v.split(':'))
+  return ret
+
+# ###########################################################################
+# Server
+# ###########################################################################
+
+class _Handler ( BaseHTTPServer.BaseHTTPRequestHandler ):
+  protocol_version        = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  wbufsize                = -1
+
+  def log_message ( self, *args ):
+    pass
+
+  def do_GET ( self ):
+    emu   = self.server.emulator
+    emu.count('requests')
+    fault = emu.fault(self.path)
+    (status, head, body) = emu.respond(self.path, self.headers)
+    if emu.latency: time.sleep(emu.latency)
+
+    # Faults
+    if fault:
+      emu.count('fault_' + fault[0])
+      if fault[0] == 'slow':
+        time.sleep(fault[1])
+      elif fault[0] == 'hang':
+        time.sleep(fault[1])
+        self.close_connection = 1
+        return
+      elif fault[0] == 'reset':
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = 1
+        return
+      elif fault[0] == 'truncate':
+        body = body[:len(body) // 2]
+      elif fault[0] == 'burst':
+        (status, body) = (503, '{"error":"service unavailable"}')
+
+    # Compress
+    if body and emu.gzip and 'gzip' in self.headers.get('accept-encoding', ''):
+      c    = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      body = c.compress(body) + c.flush()
+      head['Content-Encoding'] = 'gzip'
+
+    # Send
+    self.send_response(status)
+    for k in head: self.send_header(k, head[k])
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    emu.count('bytes', len(body))
+
+class _Server ( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+  daemon_threads      = True
+  allow_reuse_address = True
+  request_queue_size  = 128
+
+class Emulator:
+
+  def __init__ ( self, host = '127.0.0.1', port = 0, latency = 0.0,
+                 payload = 256, plen = 1800, gzip = True, data = None,
+                 fixture = None, faults = None, seed = 0 ):
+    self.latency  = latency
+    self.payload  = payload
+    self.plen     = plen
+    self.gzip     = gzip
+    self.data     = data
+    self._fixture = None
+    self._lock    = Lock()
+    self._counts  = {}
+    self._faults  = parse_faults(faults)
+    self._rand    = random.Random(seed)
+    self._t0      = time.time()
+    if fixture:
+      self._fixture = archive.Archive(fixture, 'replay')
+    self._server  = _Server((host, port), _Handler)
+    self._server.emulator = self
+    self._thread  = None
+
+  # Address (for ATLAS_API_HOST)
+  def address ( self ):
+    return '%s:%d' % self._server.server_address
+
+  # Counters
+  def count ( self, key, val = 1 ):
+    with self._lock:
+      self._counts[key] = self._counts.get(key, 0) + val
+
+  def counts ( self, reset = False ):
+    with self._lock:
+      ret = dict(self._counts)
+      if reset: self._counts = {}
+    return ret
+
+  # Set fault profile
+  def set_faults ( self, faults, seed = 0 ):
+    with self._lock:
+      self._faults = parse_faults(faults)
+      self._rand   = random.Random(seed)
+      self._t0     = time.time()
+
+  # Select fault for request (None if OK)
+  def fault ( self, path ):
+    if not self._faults or not path.startswith('/3.0/'): return None
+    with self._lock:
+      f = self._faults
+      if 'burst' in f and ((time.time() - self._t0) % f['burst'][0]) < f['burst'][1]:
+        return ('burst',)
+      r = self._rand.random()
+      for k in [ 'hang', 'reset', 'truncate', 'slow' ]:
+        if k not in f: continue
+        if r < f[k][0]:
+          return (k,) + tuple(f[k][1:])
+        r = r - f[k][0]
+    return None
+
+  # Build response
+  def respond ( self, path, headers ):
+    urlp = urlparse.urlparse(path)
+    q    = urlparse.parse_qs(urlp.query)
+    head = { 'Content-Type' : 'application/json' }
+
+    # Data files
+    if urlp.path.startswith('/data/') and self.data:
+      p = os.path.join(self.data, os.path.basename(urlp.path))
+      if os.path.exists(p):
+        return (200, { 'Content-Type' : 'text/plain' }, open(p).read())
+
+    # Recorded
+    elif self._fixture:
+      r = self._fixture.replay('GET', 'http://atlas.metabroadcast.com' + path)
+      if r and 'error' not in r:
+        for k in [ 'etag', 'last-modified' ]:
+          if k in r['headers']: head[k] = r['headers'][k]
+        return (r['status'], head, r['body'])
+
+    # Synthetic
+    elif urlp.path.endswith('/schedule.json'):
+      self.count('schedule')
+      try:
+        data = schedule(q['channel_id'][0], q['publisher'][0],
+                        int(q['from'][0]), int(q['to'][0]),
+                        self.plen, self.payload)
+        return (200, head, json.dumps(data))
+      except (KeyError, ValueError):
+        return (400, head, '{"error":"bad request"}')
+    elif urlp.path.endswith('/content.json'):
+      self.count('content')
+      uris = ','.join(q.get('uri', [])).split(',')
+      return (200, head, json.dumps(content(uris)))
+
+    return (404, head, '{"error":"not found"}')
+
+  # Run in background
+  def start ( self ):
+    self._thread = Thread(target=self._server.serve_forever)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  # Run in foreground
+  def serve ( self ):
+    self._server.serve_forever()
+
+  # Stop
+  def stop ( self ):
+    self._server.shutdown()
+    self._server.server_close()
+
+# ###########################################################################
+# Main
+# ###########################################################################
+
+if __name__ == '__main__':
+  from optparse import OptionParser
+  optp = OptionParser(usage='usage: %prog [options]')
+  optp.add_option('--host', default='127.0.0.1')
+  optp.add_option('--port', default=8080, type='int')
+  optp.add_option('--latency', default=0.0, type='float',
+                  help='seconds to delay each response')
+  optp.add_option('--payload', default=256, type='int',
+                  help='approximate description size (bytes)')
+  optp.add_option('--prog-len', default=1800, type='int',
+                  help='synthetic programme length (seconds)')
+  optp.add_option('--no-gzip', default=False, action='store_true')
+  optp.add_option('--data', default=None,
+                  help='directory to serve /data/ files from')
+  optp.add_option('--fixture', default=None,
+                  help='serve responses from recorded archive')
+  optp.add_option('--faults', default=None,
+                  help='fault profile (%s) or spec' % ','.join(sorted(FAULT_PROFILES)))
+  optp.add_option('--seed', default=0, type='int',
+                  help='fault injection random seed')
+  (opts, args) = optp.parse_args()
+  emu = Emulator(opts.host, opts.port, opts.latency, opts.payload,
+                 opts.prog_len, not opts.no_gzip, opts.data, opts.fixture,
+                 opts.faults, opts.seed)
+  print >>sys.stderr, 'atlas emulator listening on %s' % emu.address()
+  emu.serve()
+
+# ###########################################################################
+# Editor
+# ###########################################################################
@@ -168,7 +168,7 @@ def out_episode ( xml, e, extended = False ):
 
 def format ( epg, out, extended = True ):
 
-  now   = datetime.datetime.now().replace(tzinfo=util.TimeZoneSimple(0))
+  now   = datetime.datetime.now().replace(tzinfo=util.UTC)
   dtd   = 'xmltv.dtd'
   if extended: dtd = 'e' + dtd
   attrs = {
@@ -24,16 +24,23 @@
 # ###########################################################################
 
 # System
-import os, sys, urllib2, json, re
+import os, sys, urllib2, json, re, heapq
 import datetime, time
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock, Condition, Event
 from Queue import Queue, Empty
+from collections import deque
+import _strptime # strptime() lazily imports this, which isn't thread safe
 
 # PyEPG
-import pyepg.log   as log
-import pyepg.conf  as conf
-import pyepg.cache as cache
-import pyepg.util  as util
+import pyepg.log       as log
+import pyepg.conf      as conf
+import pyepg.cache     as cache
+import pyepg.util      as util
+import pyepg.stats     as stats
+import pyepg.archive   as archive
+import pyepg.asynchttp as asynchttp
+import pyepg.httppool  as httppool
+import pyepg.progress  as progress
 from pyepg.model import Channel, Broadcast, Brand, Series, Episode, Person
 import pyepg.model.genre as genre
 
@@ -42,58 +49,332 @@ import pyepg.model.genre as genre
 # ###########################################################################
 
 ATLAS_API_HOST = 'atlas.metabroadcast.com'
+ATLAS_DEADLINE = None # time by which grab must complete (see grab_deadline)
+
+# Fetch failure
+class AtlasFetchError ( Exception ):
+  def __init__ ( self, msg, retry = True, retry_after = None, code = None ):
+    Exception.__init__(self, msg)
+    self.retry       = retry
+    self.retry_after = retry_after
+    self.code        = code # HTTP status
+
+# Fetch (or retry) not made because of the grab deadline
+class AtlasDeadline ( AtlasFetchError ):
+  def __init__ ( self, err = None ):
+    msg = 'grab deadline reached'
+    if err is not None: msg = msg + ' [e=%s]' % err
+    AtlasFetchError.__init__(self, msg, False)
+
+# Publisher (for stats) of a request (else the API call)
+def atlas_url_publisher ( url ):
+  r = re.search('[?&]publisher=([^&]*)', url)
+  if not r: r = re.search('/3.0/([^.?]*)', url)
+  if r: return r.group(1)
+  return url
+
+# Record fetch failure
+def atlas_failed ( url, final = False ):
+  pub = atlas_url_publisher(url)
+  stats.inc('atlas_failures[%s]' % pub)
+  if final: stats.inc('atlas_giveups[%s]' % pub)
+
+# Get failure counts by publisher
+def atlas_failures ():
+  ret = {}
+  for (k, v) in stats.all('atlas_failures[').items():
+    ret[k[15:-1]] = v
+  return ret
+
+# Parse Retry-After header (delta seconds or HTTP date)
+def atlas_retry_after ( val ):
+  import email.utils
+  ret = None
+  if val:
+    try:
+      ret = float(val)
+    except ValueError:
+      t = email.utils.parsedate_tz(val)
+      if t: ret = email.utils.mktime_tz(t) - time.time()
+  if ret is not None: ret = max(0.0, ret)
+  return ret
 
-# Fetch raw data from atlas
-def atlas_fetch ( url, conn ):
+# Convert HTTP status (and headers) to a fetch error
+def atlas_http_error ( code, reason, head ):
+  retry = code >= 500 or code in [ 408, 429 ]
+  ra    = None
+  if code in [ 429, 503 ]:
+    ra = atlas_retry_after(head.get('retry-after') or head.get('Retry-After'))
+  return AtlasFetchError('HTTP %d %s' % (code, reason), retry, ra, code)
+
+# Grab deadline has passed, or will have in delay seconds (no further
+# requests are made)
+def atlas_deadline_passed ( delay = 0 ):
+  return ATLAS_DEADLINE is not None and\
+         (time.time() + delay) >= ATLAS_DEADLINE
+
+# Delay before next attempt (None=give up)
+#
+# Exponential back-off with jitter, so that a burst of failures doesn't
+# retry in lock step, but never sooner than the server asked for. No
+# retry is made that would fall after the grab deadline (unless deadline
+# is False, the caller then checks).
+def atlas_retry_delay ( attempt, err = None, deadline = True ):
+  import random
+  limit = conf.get('atlas_retry_limit', 5)
+  base  = conf.get('atlas_retry_base',  2.0)
+  cap   = conf.get('atlas_retry_cap',   60.0)
+  if attempt >= limit: return None
+  if err is not None and not getattr(err, 'retry', True): return None
+  ret = min(cap, base * (2 ** (attempt - 1)))
+  ret = (ret / 2) + random.uniform(0, ret / 2)
+  ra  = getattr(err, 'retry_after', None)
+  if ra is not None:
+    ret = max(ret, ra)
+  if deadline and atlas_deadline_passed(ret):
+    return None
+  return ret
+
+# Schedule response cache entry for request
+#
+# Note: only aligned requests (see atlas_time_align) are cached, otherwise
+#       the times differ on every run and the entries are never re-used
+#
+# @return (name, ttl) or None if not cacheable
+def atlas_schedule_cache ( url ):
+  import urlparse
+  if not conf.get('atlas_sched_cache', True): return None
+  if not conf.get('atlas_time_align', 0): return None
+  urlp = urlparse.urlparse(url)
+  if not urlp.path.endswith('/schedule.json'): return None
+  q    = urlparse.parse_qs(urlp.query)
+  try:
+    cid  = q['channel_id'][0]
+    pub  = q['publisher'][0]
+    tf   = int(q['from'][0])
+    tt   = int(q['to'][0])
+    anno = q.get('annotations', [ '' ])[0]
+  except (KeyError, ValueError):
+    return None
+  name = 'atlas/schedule/%s/%s/%d-%d-%s.json'\
+       % (cid, pub, tf, tt, cache.md5(anno)[:8])
+
+  # Near term schedules change more often
+  if (tf - time.time()) < conf.get('atlas_sched_cache_near', 2 * 86400):
+    ttl = conf.get('atlas_sched_cache_ttl_near', 900)
+  else:
+    ttl = conf.get('atlas_sched_cache_ttl_far', 6 * 3600)
+  return (name, ttl)
+
+# Fetch raw response from atlas (single attempt)
+def atlas_fetch_raw ( url, conn = None ):
+  import urllib2
+  sc = atlas_schedule_cache(url)
+  try:
+    if sc:
+      data = cache.get_url_cached(url, sc[0], sc[1], conn)
+    else:
+      data = cache.get_url(url, cache=False, conn=conn)
+  except urllib2.HTTPError, e:
+    raise atlas_http_error(e.code, e.msg, e.hdrs or {})
+  except archive.ArchiveMissing, e:
+    raise AtlasFetchError(str(e.reason), False)
+  if not data:
+    raise AtlasFetchError('empty response')
+  return data
+
+# Decode response
+def atlas_decode ( url, data ):
+  log.debug('decode json', 3)
+  try:
+    jdata = json.loads(data)
+  except ValueError:
+    sc = atlas_schedule_cache(url)
+    if sc: cache.url_cache_drop(sc[0])
+    raise
+  log.debug(jdata, 5, pprint=True)
+  if not jdata:
+    raise AtlasFetchError('empty response')
+  return jdata
+
+# Fetch raw data from atlas (single attempt)
+def atlas_fetch_once ( url, conn = None ):
+  return atlas_decode(url, atlas_fetch_raw(url, conn))
+
+# Full API URL
+def atlas_url ( url ):
+  return ('http://%s/3.0/' % ATLAS_API_HOST) + url
+
+# Fetch raw data from atlas (conn=None uses the shared connection pool)
+#
+# @param errors list to append the final error to (on failure)
+def atlas_fetch ( url, conn = None, errors = None ):
   jdata = None
-  url   = ('http://%s/3.0/' % ATLAS_API_HOST) + url
+  url   = atlas_url(url)
   log.debug('fetch %s' % url, 2)
   
-  # Can fail occasionally - give more than 1 attempt
-  t = 2.0
-  for i in range(5):
+  # Can fail occasionally - give more than 1 attempt (the final error, an
+  # AtlasDeadline if cut short by the deadline, is added to errors)
+  i   = 0
+  err = None
+  while True:
+    if atlas_deadline_passed():
+      err = AtlasDeadline(err)
+      break
     try:
-      data = cache.get_url(url, cache=False, conn=conn)
-      if data:
-        log.debug('decode json', 3)
-        jdata = json.loads(data)
-        log.debug(jdata, 5, pprint=True)
-        break
+      jdata = atlas_fetch_once(url, conn)
+      err   = None
+      break
     except Exception, e:
-      import traceback
-      traceback.print_ex
       log.warn('failed to fetch %s [e=%s]' % (url, e))
-      pass
-    time.sleep(t)
-    t *= 2
+      i   = i + 1
+      err = e
+      t   = atlas_retry_delay(i, e, False)
+      if t is not None and atlas_deadline_passed(t):
+        err = AtlasDeadline(e)
+        t   = None
+      atlas_failed(url, t is None)
+      if t is None: break
+      time.sleep(t)
   if not jdata:
+    if errors is not None and err is not None: errors.append(err)
     log.error('failed to fetch %s, giving up' % url)
   return jdata
 
 # Get content data
-def atlas_fetch_content ( uri, key = None ):
+def atlas_fetch_content ( uri, key = None, errors = None ):
   url = 'content.json?uri=%s' % uri
   if key:
     url = url + '&apiKey=%s' % key
-  return atlas_fetch(url)
+  return atlas_fetch(url, errors=errors)
+
+# Parsed times (the same times appear many times over, as the end of one
+# broadcast and the start of the next, in each publisher's schedule)
+ATLAS_TIME_CACHE      = {}
+ATLAS_TIME_CACHE_SIZE = 100000
 
-# Parse time
+# Parse time (YYYY-MM-DDTHH:MM:SSZ)
 def atlas_p_time ( tm ):
-  ret = datetime.datetime.strptime(tm, '%Y-%m-%dT%H:%M:%SZ')
-  ret = ret.replace(tzinfo=util.TimeZoneSimple(0))
+  ret = ATLAS_TIME_CACHE.get(tm)
+  if ret is not None: return ret
+
+  # Fixed format
+  if len(tm) == 20 and tm[4] == tm[7] == '-' and tm[10] == 'T' and\
+     tm[13] == tm[16] == ':' and tm[19] == 'Z' and\
+     (tm[0:4] + tm[5:7] + tm[8:10] + tm[11:13] + tm[14:16] + tm[17:19]).isdigit():
+    ret = datetime.datetime(int(tm[0:4]), int(tm[5:7]), int(tm[8:10]),
+                            int(tm[11:13]), int(tm[14:16]), int(tm[17:19]),
+                            0, util.UTC)
+
+  # Anything else strptime() will accept (or reject)
+  else:
+    ret = datetime.datetime.strptime(tm, '%Y-%m-%dT%H:%M:%SZ')
+    ret = ret.replace(tzinfo=util.UTC)
+
+  if len(ATLAS_TIME_CACHE) >= ATLAS_TIME_CACHE_SIZE:
+    ATLAS_TIME_CACHE.clear()
+  ATLAS_TIME_CACHE[tm] = ret
   return ret
 
 # ###########################################################################
 # Data fetch routines
 # ###########################################################################
 
+#
+# Content URIs atlas could not resolve (negative cache)
+#
+# Entries expire after atlas_content_missing_ttl seconds, or after
+# atlas_content_failed_ttl if the lookup failed (rather than atlas not
+# knowing the URI), and are kept between runs. The number of lookups
+# skipped for each is recorded to report the worst offenders.
+#
+class MissingContent:
+
+  def __init__ ( self, name = 'atlas/missing.json' ):
+    self._name = name
+    self._lock = Lock()
+    self._ents = {} # 'type uri' -> { 'time', 'ttl', 'count' }
+    self._hits = {} # 'type uri' -> lookups skipped (this run)
+    if not name: return
+    (data, meta, ok, valid) = cache._get_file(name, 0)
+    if data and valid:
+      try:
+        self._ents = json.loads(data)
+      except ValueError: pass
+
+  # Check for entry
+  def __contains__ ( self, key ):
+    return self._check(key, False)
+
+  # Check for entry, counting the lookup skipped if found
+  def skip ( self, key ):
+    return self._check(key, True)
+
+  def _check ( self, key, count ):
+    k = '%s %s' % (key[1], key[0])
+    with self._lock:
+      e = self._ents.get(k)
+      if not e: return False
+      if (time.time() - e['time']) >= e['ttl']:
+        del self._ents[k]
+        return False
+      if count:
+        self._hits[k] = self._hits.get(k, 0) + 1
+      return True
+
+  # Add entry (failed=True if the lookup failed, rather than found nothing)
+  def add ( self, key, failed = False ):
+    k   = '%s %s' % (key[1], key[0])
+    ttl = conf.get('atlas_content_missing_ttl', 86400)
+    if failed:
+      ttl = conf.get('atlas_content_failed_ttl', 3600)
+    with self._lock:
+      e = self._ents.setdefault(k, { 'count' : 0 })
+      e['time']  = time.time()
+      e['ttl']   = ttl
+      e['count'] = e['count'] + 1
+      self._hits.setdefault(k, 0)
+    stats.inc('atlas_content_missing')
+
+  # Store (expired entries are dropped)
+  def save ( self ):
+    if not self._name: return
+    now = time.time()
+    with self._lock:
+      for k in self._ents.keys():
+        if (now - self._ents[k]['time']) >= self._ents[k]['ttl']:
+          del self._ents[k]
+      data = json.dumps(self._ents, sort_keys=True)
+    cache.put_file(self._name, data)
+
+  # Log the unresolved URIs that were looked up most (this run)
+  def report ( self, num = 10 ):
+    with self._lock:
+      hits = sorted(self._hits.items(), key=lambda x: (-x[1], x[0]))
+    if not hits: return
+    stats.set('atlas_content_missing_skipped', sum(map(lambda x: x[1], hits)))
+    log.info('atlas - %d unresolved brands/series, top %d:'\
+             % (len(hits), min(num, len(hits))))
+    for (k, n) in hits[:num]:
+      log.info('atlas -   %5d lookups skipped %s' % (n, k))
+
+CONTENT_MISSING = MissingContent(None)
+
 #
 # Fetch (and validate) content
 #
+#
+# Note: a 404 means atlas doesn't know the URI, rather than a failure, and
+#       lookups cut short by the grab deadline aren't recorded at all
+#
 def get_content ( uri, type ):
-  ret = None
+  ret  = None
+  data = None
+  errs = []
+  if CONTENT_MISSING.skip((uri, type)): return None
+  if atlas_deadline_passed(): return None
   try:
-    data = atlas_fetch_content(uri)
+    data = atlas_fetch_content(uri, errors=errs)
     if data and 'contents' in data:
       for c in data['contents']:
         if 'type' in c and c['type'] == type:
@@ -101,28 +382,135 @@ def get_content ( uri, type ):
           break
   except Exception, e:
     log.error(str(e))
+  if ret is None:
+    if filter(lambda e: isinstance(e, AtlasDeadline), errs): return None
+    failed = not data and not filter(lambda e: getattr(e, 'code', None) == 404,
+                                     errs)
+    CONTENT_MISSING.add((uri, type), failed)
   return ret
 
+#
+# Resolve brand/series references for a schedule
+#
+# Where the schedule annotations only carried a URI the content is fetched
+# in batches (content.json takes a list of URIs) and cached, rather than
+# with one request per URI as each episode is processed
+#
+def resolve_content ( sched ):
+  size = conf.get('atlas_content_batch', 20)
+  if size <= 0: return
+
+  # Find unresolved
+  want = {}
+  for i in sched:
+    c     = i.get('container', {})
+    s     = i.get('series_summary', {})
+    c_uri = c.get('uri')
+    s_uri = s.get('uri')
+    if c_uri and c_uri != s_uri and c.keys() == [ 'uri' ] and\
+       (c_uri, 'brand') not in CONTENT_MISSING and\
+       cache.get_brand(c_uri) is None:
+      want[c_uri] = 'brand'
+    if s_uri and s.keys() == [ 'uri' ] and\
+       (s_uri, 'series') not in CONTENT_MISSING and\
+       cache.get_series(s_uri) is None:
+      want[s_uri] = 'series'
+  if not want: return
+  log.debug('atlas - resolve %d brands/series' % len(want), 2)
+
+  # Fetch
+  for uris in util.chunk(sorted(want), size):
+    data = None
+    try:
+      data = atlas_fetch_content(','.join(uris))
+    except Exception, e:
+      log.error(str(e))
+    if not data: continue
+    stats.inc('atlas_content_batches')
+    stats.inc('atlas_content_batched', len(uris))
+
+    # Process
+    for c in data.get('contents', []):
+      u = c.get('uri')
+      t = c.get('type')
+      if u not in want or want[u] != t: continue
+      try:
+        if t == 'brand':
+          b = process_brand(c)
+          if b: cache.put_brand(u, b)
+        else:
+          s = process_series(c)
+          if s: cache.put_series(u, s)
+      except: pass
+      del want[u]
+
+    # Not known to atlas, don't ask again individually
+    for u in uris:
+      if u in want: CONTENT_MISSING.add((u, want[u]))
+
+#
+# In-flight lookups
+#
+# The same brand/series is often needed by several data threads at once
+# (repeats across +1, regional and sister channels), concurrent lookups of
+# the same URI wait for the first to complete rather than each fetching
+# and processing it (counted as atlas_<name>_collapsed)
+#
+class SingleFlight:
+
+  def __init__ ( self, name ):
+    self._name  = name
+    self._lock  = Lock()
+    self._calls = {} # key -> (complete event, [ result ])
+
+  # Call func (or wait for the call already in progress for key)
+  def do ( self, key, func ):
+    with self._lock:
+      call = self._calls.get(key)
+      lead = call is None
+      if lead:
+        call = self._calls[key] = (Event(), [ None ])
+    if not lead:
+      stats.inc('atlas_%s_collapsed' % self._name)
+      call[0].wait()
+      return call[1][0]
+    try:
+      call[1][0] = func()
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call[0].set()
+    return call[1][0]
+
+BRAND_FLIGHTS  = SingleFlight('brand')
+SERIES_FLIGHTS = SingleFlight('series')
+
 #
 # Fetch brand
 #
 def get_brand ( uri, data = None ):
   log.debug('get_brand(%s)' % uri, 4)
 
+  # Get remote (cache checked again, a previous fetch may just have completed)
+  def _get ():
+    ret = cache.get_brand(uri)
+    if ret is None:
+      d = data
+      try:
+        if not d or d.keys() == ['uri'] :
+          d = get_content(uri, 'brand')
+        if d:
+          ret = process_brand(d)
+      except: pass
+
+      # Put in cache
+      if ret: cache.put_brand(uri, ret)
+    return ret
+
   # Check the cache
   ret = cache.get_brand(uri)
-
-  # Get remote
   if ret is None:
-    try:
-      if not data or data.keys() == ['uri'] :
-        data = get_content(uri, 'brand')
-      if data:
-        ret = process_brand(data)
-    except: pass
-
-    # Put in cache
-    if ret: cache.put_brand(uri, ret)
+    ret = BRAND_FLIGHTS.do(uri, _get)
   return ret
 
 #
@@ -131,21 +519,26 @@ def get_brand ( uri, data = None ):
 def get_series ( uri, data = None ):
   log.debug('get_series(%s)' % uri, 4)
 
+  # Get remote (cache checked again, a previous fetch may just have completed)
+  def _get ():
+    ret = cache.get_series(uri)
+    if ret is None:
+      d = data
+      try:
+        if not d or d.keys() == [ 'uri' ]:
+          d = get_content(uri, 'series')
+        if d:
+          ret = process_series(d)
+      except: pass
+
+      # Cache
+      if ret: cache.put_series(uri, ret)
+    return ret
+
   # Check cache
   ret = cache.get_series(uri)
-
-  # Get remote
   if ret is None:
-    try:
-      if not data or data.keys() == [ 'uri' ]:
-        data = get_content(uri, 'series')
-      if data:
-        ret = process_series(data)
-    except: pass
-
-    # Cache
-    if ret: cache.put_series(uri, ret)
-
+    ret = SERIES_FLIGHTS.do(uri, _get)
   return ret
 
 #
@@ -385,8 +778,11 @@ def process_episode ( data ):
   return e
 
 # Process schedule
-def process_schedule ( epg, chn, sched ):
-  p = None
+#
+# @return the broadcasts (to be added to the EPG)
+def process_schedule ( chn, sched ):
+  ret = []
+  p   = None
 
   # Process items
   for i in sched:
@@ -434,101 +830,101 @@ def process_schedule ( epg, chn, sched ):
     else:    s.lines = 576
 
     # Add
-    epg.add_broadcast(s)
+    ret.append(s)
     p = s
+  return ret
+
+#
+# Overlay one entry onto another (values in b take precedence)
+#
+def overlay_entry ( a, b, ignore ):
+  if type(b) == dict:
+    for k in b:
+      if k not in a:
+        a[k] = b[k]
+      elif k not in ignore:
+        a[k] = overlay_entry(a[k], b[k], ignore)
+    return a
+  elif type(b) == list:
+    for i in range(len(b)):
+      if i < len(a):
+        a[i] = overlay_entry(a[i], b[i], ignore)
+      else:
+        a.append(b[i])
+    return a
+  else:
+    return b
 
 #
 # Overlay publishers for a given broadcast entry
 #
-def publisher_overlay ( a, b, pubs ):
-  ignore_keys = conf.get('atlas_overlay_ignore', [ 'uri' ])#, 'transmission_end_time' ])
-  pa   = a['publisher']['key']
-  pb   = b['publisher']['key']
-  ia   = -1
-  ib   = -1
-  try:
-    ia = pubs.index(pa)
-  except: pass
-  try:
-    ib = pubs.index(pb)
-  except: pass
-  def _overlay ( a, b ):
-    if type(b) == dict:
-      for k in b:
-        if k not in a:
-          a[k] = b[k]
-        elif k not in ignore_keys:
-          a[k] = _overlay(a[k], b[k])
-      return a
-    elif type(b) == list:
-      for i in range(len(b)):
-        if i < len(a):
-          a[i] = _overlay(a[i], b[i])
-        else:
-          a.append(b[i])
-      return a
-    else:
-      return b
-  ret = None
-  if ib < ia:
-    t = a
-    a = b
-    b = t
-  args = (a['uri'], a['broadcasts'][0]['transmission_time'].strftime('%H:%M'), a['broadcasts'][0]['transmission_end_time'].strftime('%H:%M'), b['uri'], b['broadcasts'][0]['transmission_time'].strftime('%H:%M'), b['broadcasts'][0]['transmission_end_time'].strftime('%H:%M'))
-  log.debug('overlay %s @ %s-%s with %s @ %s-%s' % args, 6)
-  ret = _overlay(a, b)
-  return ret
+# rank maps publisher key to its position in the publisher list, entries
+# from later publishers take precedence (unknown publishers rank lowest)
+#
+def publisher_overlay ( a, b, rank, ignore ):
+  if rank.get(b['publisher']['key'], -1) < rank.get(a['publisher']['key'], -1):
+    (a, b) = (b, a)
+  if log.debug_enabled(6):
+    ab = a['broadcasts'][0]
+    bb = b['broadcasts'][0]
+    log.debug('overlay %s @ %s-%s with %s @ %s-%s'\
+              % (a['uri'], ab['transmission_time'].strftime('%H:%M'),
+                 ab['transmission_end_time'].strftime('%H:%M'),
+                 b['uri'], bb['transmission_time'].strftime('%H:%M'),
+                 bb['transmission_end_time'].strftime('%H:%M')), 6)
+  return overlay_entry(a, b, ignore)
 
 #
 # Process publisher overlay for entire schedule, will attempt to
 # match then overlay each schedule entry
 #
+# Entries are bucketed by start time (keeping their input order within
+# each bucket), in each bucket:
+#
+#   - leading zero length entries are passed through as is
+#   - the first other entry has the rest overlaid onto it
+#   - later zero length entries are dropped
+#
 # Note: at this point sched is NOT sorted by broadcast time
 #
 def process_publisher_overlay ( sched, pubs ):
-  ret = []
-
-  # Sort schedule into order based on start time
-  def _cmp ( a, b ):
-    t = a['broadcasts'][0]['transmission_time']\
-      - b['broadcasts'][0]['transmission_time']
-    t = util.total_seconds(t)
-    if t < 0: return -1
-    if t > 0: return 1
-    return 0
-  sched = sorted(sched, _cmp)
+  ret    = []
+  ignore = conf.get('atlas_overlay_ignore', [ 'uri' ])
+  rank   = {}
+  for i in range(len(pubs) - 1, -1, -1):
+    rank[pubs[i]] = i
+
+  # Bucket by start time
+  bkts = {}
+  for s in sched:
+    t = s['broadcasts'][0]['transmission_time']
+    if t in bkts:
+      bkts[t].append(s)
+    else:
+      bkts[t] = [ s ]
 
   # Overlay
-  num = len(sched)
-  i   = 0
-  j   = 1
-  while i < num:
+  for t in sorted(bkts):
+    a = None
+    for b in bkts[t]:
 
-    # Terminate
-    if j == num:
-      ret.append(sched[i])
-      break
-    
-    # Get entries
-    a  = sched[i]
-    b  = sched[j]
-    at = a['broadcasts'][0]['transmission_time']
-    bt = b['broadcasts'][0]['transmission_time']
-
-    # Zero length/Unmatch (add and next)
-    if a['broadcasts'][0]['transmission_end_time'] == at or at != bt:
-      ret.append(a)
-      i = j
-      j = j + 1
-
-    # Ignore
-    elif b['broadcasts'][0]['transmission_end_time'] == bt:
-      j = j + 1
-
-    # Overlay
-    else:
-      sched[i] = publisher_overlay(a, b, pubs)
-      j = j + 1
+      # First
+      if a is None:
+        a = b
+
+      # Zero length (add and next)
+      elif a['broadcasts'][0]['transmission_end_time'] == t:
+        ret.append(a)
+        a = b
+
+      # Ignore
+      elif b['broadcasts'][0]['transmission_end_time'] == t:
+        pass
+
+      # Overlay
+      else:
+        a = publisher_overlay(a, b, rank, ignore)
+    ret.append(a)
 
   return ret
 
@@ -569,128 +965,882 @@ def filter_channels ( channels ):
       log.warn('unable to find EPG info for %s' % t.uri)
   return chns
 
+# Schedule request config, returns (url base, primary, secondary publishers)
+def atlas_schedule_conf ():
+  key    = conf.get('atlas_apikey', None)
+  p_pubs = conf.get('atlas_primary_publishers',\
+                    [ 'bbc.co.uk', 'itv.com' 'tvblob.com',\
+                      'channel4.com' ])
+  s_pubs = conf.get('atlas_secondary_publishers',\
+                    [ 'pressassociation.com' ])
+  anno   = [ 'broadcasts', 'extended_description', 'series_summary',\
+             'brand_summary', 'people' ]
+
+  # URL base
+  url = 'schedule.json?'
+  url = url + 'annotations=' + ','.join(anno)
+  if key:  url = url + '&apiKey=' + key
+  return (url, p_pubs, s_pubs)
+
+# Publishers to fetch for a channel (in overlay order)
+def atlas_publishers ( c, p_pubs, s_pubs ):
+  pubs = []
+  for p in s_pubs: pubs.append(p)
+  for p in p_pubs:
+    if p in c.publisher: pubs.append(p)
+  return pubs
+
+# Group channels that would make identical schedule requests (same Atlas
+# channel and publishers, the time window is common to the grab), e.g.
+# regional variants mapped to the same Atlas channel. Only the first of
+# each is fetched
+#
+# @return (channels to fetch, { id(channel) : [ channels sharing it ] })
+def atlas_shared_channels ( channels ):
+  (url, p_pubs, s_pubs) = atlas_schedule_conf()
+  ret    = []
+  shared = {}
+  first  = {}
+  for c in channels:
+    k = (c.shortid, tuple(atlas_publishers(c, p_pubs, s_pubs)))
+    if k in first:
+      shared.setdefault(id(first[k]), []).append(c)
+    else:
+      first[k] = c
+      ret.append(c)
+  return (ret, shared)
+
+# Split grab period into request time chunks
+#
+# If atlas_time_align is set the chunks are snapped to fixed UTC boundaries
+# (multiples of the alignment since the epoch) so that the same requests are
+# made from run to run, the results are then trimmed to the real period
+# (see atlas_time_window)
+def atlas_time_chunks ( start, stop ):
+  ret     = []
+  tsize   = conf.get('atlas_time_chunk', stop - start)
+  align   = conf.get('atlas_time_align', 0)
+  tm_from = time.mktime(start.timetuple())
+  tm_to   = time.mktime(stop.timetuple())
+  if type(tsize) == datetime.timedelta:
+    tsize = util.total_seconds(tsize)
+  if align:
+    tsize   = max(1, int(round(float(tsize) / align))) * align
+    tm_from = (int(tm_from) // tsize) * tsize
+    tm_to   = -(-int(tm_to) // tsize) * tsize
+  tf = tm_from
+  while tf < tm_to:
+    tt = min(tf + tsize, tm_to)
+    ret.append((tf, tt))
+    tf = tf + tsize
+  return ret
+
+# Period to trim aligned results to (None if not aligned)
+#
+# Note: returned as atlas (UTC) time strings, these sort correctly so the
+#       raw schedule entries can be compared without parsing
+def atlas_time_window ( start, stop ):
+  if not conf.get('atlas_time_align', 0): return None
+  fmt = '%Y-%m-%dT%H:%M:%SZ'
+  return (time.strftime(fmt, time.gmtime(time.mktime(start.timetuple()))),
+          time.strftime(fmt, time.gmtime(time.mktime(stop.timetuple()))))
+
+# Remove entries outside of period
+def atlas_trim_items ( items, window ):
+  ret      = []
+  (tf, tt) = window
+  for i in items:
+    try:
+      bc = i['broadcasts'][0]
+      a  = bc['transmission_time']
+      b  = bc['transmission_end_time']
+      if a < tt and (b > tf or (a == b and a >= tf)):
+        ret.append(i)
+    except (KeyError, IndexError):
+      ret.append(i)
+  return ret
+
+# Fields an entry must have to cover its time chunk (broadcasts.<key> for
+# the broadcast), by default those the secondary publishers supply for
+# every programme, see ATLAS_COVERAGE_KEYS
+def atlas_coverage_fields ():
+  return conf.get('atlas_coverage_fields', ATLAS_COVERAGE_KEYS)
+
+# Check a schedule response covers [tf, tt) (epoch seconds, further limited
+# by the time window) without any gaps, and that every entry has all of the
+# atlas_coverage_fields (data may be the undecoded response)
+#
+# Note: a field that is present (even if empty/false) is sufficient, the
+#       lead publisher's value takes precedence in the overlay
+#
+# Note: the skipped publishers' values are never seen, so the output is not
+#       identical. In particular the episode uri, which is normally taken
+#       from the lowest precedence publisher (see atlas_overlay_ignore), is
+#       the lead publisher's, and neither fields only some programmes have
+#       (e.g. year, episode_number) nor extra list entries (e.g. people)
+#       are added.
+def atlas_covered ( data, tf, tt, window = None ):
+  fmt  = '%Y-%m-%dT%H:%M:%SZ'
+  keys = atlas_coverage_fields()
+  tf   = time.strftime(fmt, time.gmtime(tf))
+  tt   = time.strftime(fmt, time.gmtime(tt))
+  if window:
+    tf = max(tf, window[0])
+    tt = min(tt, window[1])
+
+  # Entries
+  spans = []
+  try:
+    if isinstance(data, basestring):
+      data = atlas_schedule_items(json.loads(data))
+    for i in data or []:
+      bc = i['broadcasts'][0]
+      for k in keys:
+        if k.startswith('broadcasts.'):
+          if k[11:] not in bc: return False
+        elif k not in i: return False
+      spans.append((bc['transmission_time'], bc['transmission_end_time']))
+  except (ValueError, TypeError, KeyError, IndexError):
+    return False
+
+  # Gaps
+  end = tf
+  for (a, b) in sorted(spans):
+    if a > end: return False
+    end = max(end, b)
+  return end >= tt
+
+# Schedule request URL (relative to API root)
+def atlas_schedule_url ( url, c, tf, tt, p ):
+  u = url + '&from=%d&to=%d' % (tf, tt)
+  u = u + '&publisher=' + p
+  u = u + '&channel_id=' + c.shortid
+  return u
+
+# Extract schedule items from response
+def atlas_schedule_items ( data ):
+  ret = []
+  if data and 'schedule' in data:
+    for s in data['schedule']:
+      if 'items' in s:
+        ret.extend(s['items'])
+  return ret
+
+# Parse times and overlay publishers
+def atlas_prepare_schedule ( sched, pubs ):
+
+  # Process times
+  for s in sched:
+    for i in range(len(s['broadcasts'])):
+      for k in s['broadcasts'][i]:
+        if 'time' in k:
+          try:
+            s['broadcasts'][i][k] = atlas_p_time(s['broadcasts'][i][k])
+          except: pass
+
+  # Process overlays
+  return process_publisher_overlay(sched, pubs)
+
+# ###########################################################################
+# Data stage worker processes
+# ###########################################################################
+
+#
+# With atlas_data_procs set, JSON decode, time parsing and the overlay are
+# done by a pool of worker processes (so are not limited by the GIL). The
+# grab threads pass on the raw responses and the data threads hand them
+# to the pool, getting back compact schedule entries (only the fields
+# used by process_schedule) which are then added to the EPG as usual.
+#
+# Note: brand/series resolution still happens in the parent, so that
+#       lookups are shared between channels
+#
+ATLAS_POOL = None
+
+# Schedule entry fields used (see process_schedule/process_episode)
+ATLAS_ITEM_KEYS = [ 'uri', 'title', 'description', 'episode_number',
+                    'genres', 'schedule_only', 'media_type', 'container',
+                    'series_summary', 'specialization', 'year',
+                    'black_and_white', 'people' ]
+
+# Broadcast fields used (see process_schedule)
+ATLAS_BROADCAST_KEYS = [ 'high_definition', 'widescreen', 'premiere',
+                         'new_series', 'repeat', 'signed', 'subtitled',
+                         'audio_described' ]
+
+# Fields for a lead publisher's entry to cover the others' (see
+# atlas_covered)
+ATLAS_COVERAGE_KEYS = [ 'title', 'description', 'genres', 'people',
+                        'broadcasts.repeat', 'broadcasts.subtitled',
+                        'broadcasts.signed', 'broadcasts.audio_described' ]
+
+# Compact schedule entry
+def atlas_compact_item ( item ):
+  ret = {}
+  for k in ATLAS_ITEM_KEYS:
+    if k in item: ret[k] = item[k]
+  ret['broadcasts'] = item['broadcasts'][:1]
+  return ret
+
+#
+# Decode raw responses (worker process)
+#
+# @return (compact schedule, indexes of responses that failed to decode)
+#
+def atlas_decode_schedule ( data, pubs, tf = None, tt = None, window = None ):
+  sched = []
+  bad   = []
+  for i in range(len(data)):
+    if not data[i]: continue
+    try:
+      sched.extend(atlas_schedule_items(json.loads(data[i])))
+    except ValueError:
+      bad.append(i)
+  if tf is not None or tt is not None:
+    sched = atlas_chunk_items(sched, tf, tt)
+  if window:
+    sched = atlas_trim_items(sched, window)
+  sched = atlas_prepare_schedule(sched, pubs)
+  return (map(atlas_compact_item, sched), bad)
+
+#
+# Undecoded schedule responses (passed from grab to data stage)
+#
+class RawSchedule:
+
+  def __init__ ( self, urls, data, tf = None, tt = None, window = None ):
+    self.urls   = urls
+    self.data   = data
+    self.tf     = tf
+    self.tt     = tt
+    self.window = window
+
+  # Decode (using process pool)
+  #
+  # Note: responses that fail to decode are re-fetched (once) here, as the
+  #       grab stage doesn't decode them
+  def decode ( self, pubs ):
+    data = list(self.data)
+    for n in range(2):
+      try:
+        (ret, bad) = ATLAS_POOL.apply(atlas_decode_schedule,
+                                      (data, pubs, self.tf, self.tt,
+                                       self.window))
+      except Exception, e:
+        log.error('atlas - failed to decode schedule [e=%s]' % e)
+        return []
+      if not bad: break
+
+      # Re-fetch bad responses
+      for i in bad:
+        u  = self.urls[i]
+        sc = atlas_schedule_cache(u)
+        if sc: cache.url_cache_drop(sc[0])
+        atlas_failed(u, n > 0)
+        data[i] = None
+        if n:
+          log.error('failed to decode %s, giving up' % u)
+          continue
+        log.warn('failed to decode %s, refetching' % u)
+        try:
+          data[i] = atlas_fetch_raw(u)
+        except Exception, e:
+          log.error('failed to fetch %s [e=%s]' % (u, e))
+    return ret
+
+# ###########################################################################
+# Channel cost history
+# ###########################################################################
+
+#
+# Per channel fetch/processing cost, persisted between runs and used to
+# order the grab queue longest first (LPT) so that the heaviest channels
+# don't start last and extend the tail of the grab
+#
+# Each run's measurements are blended with the history (weight given by
+# atlas_cost_weight) to smooth out one-off slow runs
+#
+class CostModel:
+
+  def __init__ ( self, name = 'atlas/cost.json' ):
+    self._name = name
+    self._lock = Lock()
+    self._hist = {}
+    self._cur  = {}
+    (data, meta, ok, valid) = cache._get_file(name, 0)
+    if data and valid:
+      try:
+        self._hist = json.loads(data)
+      except ValueError: pass
+
+  # Add measurements for channel
+  def update ( self, c, **vals ):
+    with self._lock:
+      cur = self._cur.setdefault(c.uri, {})
+      for k in vals:
+        cur[k] = cur.get(k, 0) + vals[k]
+
+  # Predicted cost (seconds) of channel (None if unknown)
+  def cost ( self, c ):
+    h = self._hist.get(c.uri)
+    if not h: return None
+    return h.get('fetch', 0) + h.get('proc', 0)
+
+  # Order channels, most expensive first (unknown channels are assumed to
+  # be of average cost)
+  def order ( self, channels ):
+    known = filter(lambda x: x is not None, map(self.cost, channels))
+    if not known: return channels
+    avg   = sum(known) / len(known)
+    def _cost ( c ):
+      ret = self.cost(c)
+      if ret is None: ret = avg
+      return ret
+    return sorted(channels, key=_cost, reverse=True)
+
+  # Predicted makespan (list schedule of channel costs over workers)
+  def makespan ( self, channels, workers ):
+    known = filter(lambda x: x is not None, map(self.cost, channels))
+    if not known: return None
+    avg   = sum(known) / len(known)
+    ends  = [ 0.0 ] * max(1, workers)
+    for c in channels:
+      t = self.cost(c)
+      if t is None: t = avg
+      heapq.heapreplace(ends, ends[0] + t)
+    return max(ends)
+
+  # Blend this run into the history and store
+  def save ( self ):
+    w = conf.get('atlas_cost_weight', 0.5)
+    with self._lock:
+      for u in self._cur:
+        h = self._hist.setdefault(u, {})
+        for (k, v) in self._cur[u].items():
+          if k in h: v = (w * v) + ((1 - w) * h[k])
+          h[k] = v
+      self._cur = {}
+      data = json.dumps(self._hist, sort_keys=True)
+    cache.put_file(self._name, data)
+
+ATLAS_COST = None
+
 # ###########################################################################
 # Threads
 # ###########################################################################
 
 #
-# Fetch data
+# Channel fetch job (all schedule requests for a channel)
+#
+# Each request (time chunk, publisher) is an independent unit of work, the
+# results are reassembled here, in request order, either per time chunk
+# (streaming) or for the channel as a whole
 #
-class GrabThread ( Thread ):
+class GrabJob:
+
+  def __init__ ( self, chn, pubs, urls, window = None, chunks = None ):
+    if chunks is None: chunks = []
+    self.chn     = chn
+    self.pubs    = pubs
+    self.urls    = urls
+    self.window  = window
+    self.chunks  = chunks
+    self.started = time.time()
+    self.res     = [ None ] * len(urls)
+    self.sizes   = [ 0 ] * len(urls)
+    self.tries   = [ 0 ] * len(urls)
+    self.due     = [ 0 ] * len(urls)
+    self.remain  = len(urls)
+    self.bytes   = 0
+    self.items   = 0
+    self.time    = 0.0
+    self.partial = False
+    self._lock   = Lock()
+    self._chunk  = [ len(pubs) ] * len(chunks)
+    self._cancel = False
+    self._held   = {} # time chunk -> held request indexes
+
+  # Request complete (items=[] on failure)
+  #
+  # @return (index of time chunk now complete or None, job complete)
+  def done ( self, i, items, size = 0, elapsed = 0.0 ):
+    with self._lock:
+      if self._cancel: return (None, False)
+      self.res[i]   = items
+      self.sizes[i] = size
+      self.remain   = self.remain - 1
+      self.bytes    = self.bytes + size
+      self.time     = self.time + elapsed
+      k             = None
+      if self._chunk:
+        k = i // len(self.pubs)
+        self._chunk[k] = self._chunk[k] - 1
+        if self._chunk[k]: k = None
+      return (k, not self.remain)
+
+  # Hold all but the lead (highest precedence publisher) request for each
+  # time chunk, until its response shows whether they're needed
+  #
+  # @return the lead request indexes
+  def hold ( self ):
+    n   = len(self.pubs)
+    ret = []
+    for k in range(len(self.chunks)):
+      self._held[k] = range(k*n, (k+1)*n - 1)
+      ret.append((k+1)*n - 1)
+    return ret
+
+  # Release the held requests for the time chunk of request i
+  def release ( self, i ):
+    with self._lock:
+      return self._held.pop(i // len(self.pubs), [])
+
+  # Response to request i covers its time chunk
+  def covers ( self, i ):
+    (tf, tt) = self.chunks[i // len(self.pubs)]
+    return atlas_covered(self.res[i], tf, tt, self.window)
+
+  # Request failed, returns False if no more retries (request must then
+  # be marked done)
+  def failed ( self, i, err ):
+    self.tries[i] = self.tries[i] + 1
+    t = atlas_retry_delay(self.tries[i], err)
+    atlas_failed(self.urls[i], t is None)
+    if t is None:
+      log.error('failed to fetch %s, giving up' % self.urls[i])
+      self.partial = True
+      return False
+    self.due[i] = time.time() + t
+    return True
+
+  # Cancel outstanding requests, returns False if already complete
+  #
+  # Note: once cancelled, done() has no further effect
+  def cancel ( self ):
+    with self._lock:
+      if not self.remain: return False
+      self._cancel = True
+      self.partial = True
+      return True
+
+  # Complete schedule
+  def sched ( self ):
+    ret = []
+    for r in self.res:
+      if r: ret.extend(r)
+    if self.window:
+      ret = atlas_trim_items(ret, self.window)
+    self.items = len(ret)
+    return ret
+
+  # Schedule for a single time chunk
+  #
+  # Note: entries overlapping the chunk boundary are returned by both
+  #       requests, so only those starting within the chunk are kept (the
+  #       first/last chunks are open ended)
+  def chunk_sched ( self, k ):
+    n   = len(self.pubs)
+    ret = []
+    for r in self.res[k*n:(k+1)*n]:
+      if r: ret.extend(r)
+    (tf, tt) = self.chunks[k]
+    if k == 0: tf = None
+    if k == len(self.chunks) - 1: tt = None
+    ret = atlas_chunk_items(ret, tf, tt)
+    if self.window:
+      ret = atlas_trim_items(ret, self.window)
+    with self._lock:
+      self.items = self.items + len(ret)
+    return ret
+
+  # Undecoded responses (k=None for the whole channel)
+  def raw_sched ( self, k = None ):
+    if k is None:
+      return RawSchedule(self.urls, self.res, window=self.window)
+    n = len(self.pubs)
+    (tf, tt) = self.chunks[k]
+    if k == 0: tf = None
+    if k == len(self.chunks) - 1: tt = None
+    return RawSchedule(self.urls[k*n:(k+1)*n], self.res[k*n:(k+1)*n],
+                       tf, tt, self.window)
+
+  # Response size for a single time chunk
+  def chunk_bytes ( self, k ):
+    n = len(self.pubs)
+    return sum(self.sizes[k*n:(k+1)*n])
+
+  # Fetch complete (record stats)
+  def finish ( self ):
+    stats.sample('atlas_channel_fetch_time', time.time() - self.started)
+    if ATLAS_COST:
+      ATLAS_COST.update(self.chn, fetch=self.time, bytes=self.bytes,
+                        items=self.items, requests=len(self.urls))
+
+# Create a fetch job for channel
+def atlas_grab_job ( c, url, chunks, p_pubs, s_pubs, window = None ):
+  pubs = atlas_publishers(c, p_pubs, s_pubs)
+  urls = []
+  for (tf, tt) in chunks:
+    for p in pubs:
+      urls.append(atlas_url(atlas_schedule_url(url, c, tf, tt, p)))
+  return GrabJob(c, pubs, urls, window, chunks)
+
+# Lead request for a time chunk complete, the held requests are not needed
+# if its response covers the chunk (they must then be marked done)
+#
+# @return (held requests still needed, held requests not needed)
+def atlas_grab_covered ( job, i ):
+  held = job.release(i)
+  if held and job.covers(i):
+    stats.inc('atlas_requests_skipped', len(held))
+    return ([], held)
+  return (held, [])
+
+# Entries starting within [tf, tt) (epoch seconds, None=open)
+def atlas_chunk_items ( items, tf, tt ):
+  fmt = '%Y-%m-%dT%H:%M:%SZ'
+  if tf is not None: tf = time.strftime(fmt, time.gmtime(tf))
+  if tt is not None: tt = time.strftime(fmt, time.gmtime(tt))
+  ret = []
+  for i in items:
+    try:
+      a = i['broadcasts'][0]['transmission_time']
+      if (tf is None or a >= tf) and (tt is None or a < tt):
+        ret.append(i)
+    except (KeyError, IndexError):
+      ret.append(i)
+  return ret
 
-  def __init__ ( self, idx, inq, outq, start, stop ):
+#
+# Pass completed schedule(s) on for processing
+#
+# In streaming mode each time chunk is passed on as soon as all of its
+# requests are complete, rather than waiting for the entire channel. This
+# is safe for the overlay as it only ever matches entries with the same
+# start time (which always fall in the same chunk)
+#
+# Note: when streaming, a zero length entry at the very start of a chunk
+#       is not linked (followedby) to the last broadcast of the previous
+#
+def atlas_grab_output ( job, k, fin, inq, outq ):
+  if inq.raw:
+    sched = job.raw_sched
+  elif inq.stream:
+    sched = job.chunk_sched
+  else:
+    sched = lambda k: job.sched()
+  if inq.stream:
+    if not job.urls:
+      for k in range(len(job.chunks)):
+        outq.put((job.chn, job.pubs, sched(k)))
+    elif k is not None:
+      outq.put((job.chn, job.pubs, sched(k)), job.chunk_bytes(k))
+  elif fin:
+    outq.put((job.chn, job.pubs, sched(None)), job.bytes)
+  if fin:
+    job.finish()
+    inq.finished(job)
+    inq.task_done()
+    if inq.progress:
+      inq.progress.update(fetched=1 + len(inq.shared.get(id(job.chn), [])),
+                          bytes=job.bytes)
+
+# Pass on whatever has been fetched for a cancelled channel
+#
+# Note: when streaming, the complete time chunks have already been passed on
+def atlas_grab_partial ( job, inq, outq ):
+  with inq.mutex:
+    inq.partial.add(job.chn)
+  if inq.stream: return
+  if not filter(lambda r: r is not None, job.res): return
+  log.warn('atlas - partial schedule for %s' % (job.chn.title or job.chn.uri))
+  if inq.raw:
+    outq.put((job.chn, job.pubs, job.raw_sched()), job.bytes)
+  else:
+    outq.put((job.chn, job.pubs, job.sched()), job.bytes)
+
+#
+# Worker thread
+#
+# The supervisor (see grab) is woken whenever a thread exits, however
+# that happens, so it can check for premature thread death
+#
+# Note: done is set before the supervisor is woken, the thread is still
+#       alive at that point
+#
+class AtlasThread ( Thread ):
+
+  def __init__ ( self, inq ):
     Thread.__init__(self)
     self.setDaemon(True)
+    self.done = False
+    self._inq = inq
+
+  def run ( self ):
+    try:
+      self._run()
+    finally:
+      self.done = True
+      if self._inq.progress: self._inq.progress.wake()
+
+#
+# Fetch data
+#
+# Threads take single schedule requests from the input queue, so several
+# threads can be fetching for the same channel. Whichever completes the
+# last request for a channel passes it on for processing.
+#
+# Failed requests do not block the thread, they're put back on the input
+# queue to be picked up (by any thread) once the retry is due
+#
+class GrabThread ( AtlasThread ):
+
+  def __init__ ( self, idx, inq, outq, start, stop ):
+    AtlasThread.__init__(self, inq)
     self._idx    = idx
-    self._inq    = inq
     self._outq   = outq
     self._start  = start
     self._stop   = stop
 
-  def run ( self ):
-    conn = None
+  def _run ( self ):
     log.debug('atlas - grab thread %3d started' % self._idx, 0)
 
-    # Create connection
-    import httplib
-    retry = conf.get('atlas_conn_retry_limit', 5)
-    while not conn and retry:
-      try:
-        conn  = httplib.HTTPConnection(ATLAS_API_HOST)
-        log.debug('atlas - grab thread %3d conn created' % self._idx, 1)
-      except:
-        retry = retry - 1
-        time.sleep(conf.get('atlas_conn_retry_period', 2.0))
-    if not conn:
-      log.error('atlas - grab thread %3d failed to connect')
-      return
-
-    # Config
-    key    = conf.get('atlas_apikey', None)
-    p_pubs = conf.get('atlas_primary_publishers',\
-                      [ 'bbc.co.uk', 'itv.com' 'tvblob.com',\
-                        'channel4.com' ])
-    s_pubs = conf.get('atlas_secondary_publishers',\
-                      [ 'pressassociation.com' ])
-    anno   = [ 'broadcasts', 'extended_description', 'series_summary',\
-               'brand_summary', 'people' ]
-    tsize  = conf.get('atlas_time_chunk', self._stop - self._start)
-
-    # Time
-    tm_from = time.mktime(self._start.timetuple())
-    tm_to   = time.mktime(self._stop.timetuple())
-
-    # URL base
-    url = 'schedule.json?'
-    url = url + 'annotations=' + ','.join(anno)
-    if key:  url = url + '&apiKey=' + key
-
     # Until queue exhausted
     while True:
     
-      # Get next entry
-      c = None
-      try:
-        c = self._inq.get_nowait()
-      except Empty:
-        break
-      log.debug('atlas - grab thread %3d fetch   %s' % (self._idx, c.title), 0)
-      sched = []
-
-      # By time
-      tf = tm_from
-      while tf < tm_to:
-        tt = min(tf + tsize, tm_to)
-        a  = (time.strftime('%Y-%m-%d %H:%M', time.localtime(tf)),\
-              time.strftime('%Y-%m-%d %H:%M', time.localtime(tt)))
-        #log.info('atlas -     period %s to %s' % a)
-
-        # Process each publisher
-        pubs = []
-        for p in s_pubs: pubs.append(p)
-        for p in p_pubs:
-          if p in c.publisher: pubs.append(p)
-        log.debug('PUBS: %s' % pubs, 0)
-        for p in pubs:
-          #log.info('atlas -       publisher %s' % p)
-          u = url + '&from=%d&to=%d' % (tf, tt)
-          u = u + '&publisher=' + p
-          u = u + '&channel_id=' + c.shortid
-
-          # Fetch data
-          data  = atlas_fetch(u, conn)
-
-          # Processs
-          if data and 'schedule' in data:
-            for s in data['schedule']:
-              if 'items' in s:
-                sched.extend(s['items'])
-
-        # Update
-        tf = tf + tsize
+      # Get next request
+      unit = self._inq.get_unit()
+      if unit is None: break
+      (job, i) = unit
+
+      # Fetch
+      if i is None:
+        (k, fin) = (None, True)
+      else:
+        u = job.urls[i]
+        if job.tries[i]:
+          log.debug('atlas - grab thread %3d retry   %s' % (self._idx, job.chn.title), 0)
+        log.debug('fetch %s' % u, 2)
+        t = time.time()
+        try:
+          raw = atlas_fetch_raw(u)
+          if self._inq.raw:
+            items = raw
+          else:
+            items = atlas_schedule_items(atlas_decode(u, raw))
+          (k, fin) = job.done(i, items, len(raw), time.time() - t)
+        except Exception, e:
+          log.warn('failed to fetch %s [e=%s]' % (u, e))
+
+          # Requeue for retry
+          if job.failed(i, e):
+            stats.inc('atlas_requeued')
+            self._inq.retry(unit, job.due[i])
+            continue
+          (k, fin) = job.done(i, [], 0, time.time() - t)
+
+        # Skip or queue the rest of the time chunk
+        if self._inq.coverage:
+          (need, skip) = atlas_grab_covered(job, i)
+          if need or skip:
+            self._inq.release(job, need, len(need) + len(skip))
+          for j in skip:
+            (k, fin) = job.done(j, [])
 
       # Put into the output queue
-      log.debug('atlas - grab thread %3d fetched %s' % (self._idx, c.title), 1)
-      self._outq.put((c, pubs, sched))
-      self._inq.task_done()
+      if fin:
+        log.debug('atlas - grab thread %3d fetched %s' % (self._idx, job.chn.title), 1)
+      atlas_grab_output(job, k, fin, self._inq, self._outq)
 
     # Done
-    if conn: conn.close()
     log.debug('atlas - grab thread %3d complete' % self._idx, 0)
 
+#
+# Fetch data (event loop)
+#
+# A single thread drives all schedule requests through a pool of
+# persistent (pipelined) connections, channels are pulled from the input queue
+# as capacity allows and passed on once all of their requests complete
+#
+class AsyncGrabThread ( AtlasThread ):
+
+  def __init__ ( self, idx, inq, outq, start, stop ):
+    AtlasThread.__init__(self, inq)
+    self._idx    = idx
+    self._outq   = outq
+    self._start  = start
+    self._stop   = stop
+
+  def _run ( self ):
+    log.debug('atlas - async thread %3d started' % self._idx, 0)
+
+    # Config
+    self._limit  = conf.get('atlas_async_requests', 256)
+    self._client = asynchttp.Client(ATLAS_API_HOST,
+                                    conns=conf.get('atlas_async_conns', 64),
+                                    pipeline=conf.get('atlas_async_pipeline', 4),
+                                    timeout=conf.get('atlas_async_timeout', 60.0),
+                                    connect_timeout=conf.get('http_connect_timeout', 10.0),
+                                    budget=conf.get('atlas_fetch_budget', 120.0))
+
+    # Run until all channels processed (or cancelled)
+    more = True
+    while not self._inq.cancelled:
+      while more and self._client.outstanding() < self._limit:
+        more = self._submit()
+      if not more and not self._client.outstanding(): break
+      self._client.poll()
+
+    # Done
+    self._client.close()
+    if self._client.reaped:
+      stats.inc('atlas_reaped', self._client.reaped)
+    log.debug('atlas - async thread %3d complete' % self._idx, 0)
+
+  # Queue requests for next channel
+  def _submit ( self ):
+    job = self._inq.get_job()
+    if job is None: return False
+    log.debug('atlas - async thread %3d fetch   %s' % (self._idx, job.chn.title), 0)
+    reqs = range(len(job.urls))
+    if self._inq.coverage and len(job.pubs) > 1:
+      reqs = job.hold()
+    for i in reqs:
+      self._fetch(job, i)
+    if not job.urls:
+      self._output(job, None, True)
+    return True
+
+  # Queue request (or use cached response)
+  def _fetch ( self, job, i ):
+    u    = job.urls[i]
+    h    = { 'Accept-Encoding' : cache.PYEPG_ENCODING }
+    sc   = atlas_schedule_cache(u)
+    name = data = None
+
+    # Check cache
+    if sc:
+      name = sc[0]
+      (data, fresh, cond) = cache.url_cache_lookup(*sc)
+      if fresh:
+        try:
+          items = data
+          if not self._inq.raw:
+            items = atlas_schedule_items(json.loads(data))
+          self._complete(job, i, job.done(i, items, len(data)))
+          return
+        except ValueError:
+          cache.url_cache_drop(name)
+          data = None
+          cond = {}
+      h.update(cond)
+
+    # Fetch
+    log.debug('fetch %s' % u, 2)
+    self._client.request(asynchttp.Request(u, self._done, h,
+                                           (job, i, name, data)))
+
+  # Request complete
+  def _done ( self, req, resp, err ):
+    (job, i, name, cached) = req.ctx
+    data = None
+    size = 0
+    body = None
+    derr = None
+
+    # Decompress (once, the archive records the decoded body)
+    if not err:
+      try:
+        body = cache.decode_body(resp.body,
+                                 resp.headers.get('content-encoding'))
+      except Exception, e:
+        derr = e
+
+    # Record
+    if archive.recording():
+      if err or derr:
+        archive.record('GET', req.url, 0, None, None,
+                       time.time() - req.sent, err or str(derr))
+      else:
+        h = dict(resp.headers)
+        h.pop('content-encoding', None)
+        archive.record('GET', req.url, resp.status, h, body,
+                       time.time() - req.sent)
+
+    # Decode
+    try:
+      if err:
+        raise AtlasFetchError(err)
+      if resp.status not in [ 200, 304 ]:
+        raise atlas_http_error(resp.status, resp.reason, resp.headers)
+      if derr:
+        raise derr
+      if name:
+        body = cache.url_cache_update(name, resp.status, resp.headers,
+                                      body, cached)
+      size = len(body or '')
+      if not body:
+        raise AtlasFetchError('empty response')
+
+      # Passed on undecoded
+      if self._inq.raw:
+        self._complete(job, i, job.done(i, body, size, time.time() - req.sent))
+        return
+
+      log.debug('decode json', 3)
+      try:
+        data = json.loads(body)
+      except ValueError:
+        if name:
+          cache.url_cache_drop(name)
+          req.headers.pop('If-None-Match', None)
+          req.headers.pop('If-Modified-Since', None)
+        raise
+      if not data:
+        raise AtlasFetchError('empty response')
+    except Exception, e:
+      log.warn('failed to fetch %s [e=%s]' % (req.url, e))
+
+      # Retry later (loop carries on with other requests)
+      if job.failed(i, e):
+        req.resets = 0
+        self._client.request(req, job.due[i] - time.time())
+        return
+      data = None
+      size = 0
+
+    # Store
+    self._complete(job, i, job.done(i, atlas_schedule_items(data), size,
+                                    time.time() - req.sent))
+
+  # Request done, skip or fetch the rest of its time chunk then pass on
+  # anything complete
+  def _complete ( self, job, i, res ):
+    if self._inq.coverage:
+      (need, skip) = atlas_grab_covered(job, i)
+      for j in need:
+        self._fetch(job, j)
+      for j in skip:
+        res = job.done(j, [])
+    self._output(job, *res)
+
+  # Request(s) complete
+  def _output ( self, job, k, fin ):
+    if fin:
+      log.debug('atlas - async thread %3d fetched %s' % (self._idx, job.chn.title), 1)
+    atlas_grab_output(job, k, fin, self._inq, self._outq)
+
 #
 # Process data
 #
-class DataThread ( Thread ):
+class DataThread ( AtlasThread ):
 
   def __init__ ( self, idx, inq, epg ):
-    Thread.__init__(self)
-    self.setDaemon(True)
+    AtlasThread.__init__(self, inq)
     self._idx = idx
-    self._inq = inq
     self._epg = epg
 
-  def run ( self ):
+  def _run ( self ):
     log.debug('atlas - data thread %3d started' % self._idx, 0)
     while True:
       c = sched = None
@@ -699,40 +1849,164 @@ class DataThread ( Thread ):
       except Empty:
         break
       log.debug('atlas - data thread %3d process %s' % (self._idx, c.title), 0)
+      t = time.time()
+
+      # Decode/overlay (in worker process)
+      if isinstance(sched, RawSchedule):
+        log.debug('atlas - data thread %3d decode  %s' % (self._idx, c.title), 1)
+        sched = sched.decode(pubs)
+        if ATLAS_COST:
+          ATLAS_COST.update(c, items=len(sched))
 
-      # Process times
-      for s in sched:
-        for i in range(len(s['broadcasts'])):
-          for k in s['broadcasts'][i]:
-            if 'time' in k:
-              try:
-                s['broadcasts'][i][k] = atlas_p_time(s['broadcasts'][i][k])
-              except: pass
-
-      # Process overlays
-      log.debug('atlas - data thread %3d overlay %s' % (self._idx, c.title), 1)
-      log.debug('atlas - publishers %s' % pubs, 2)
-      sched = process_publisher_overlay(sched, pubs)
-
-      # Process into EPG
+      # Process times/overlays
+      else:
+        log.debug('atlas - data thread %3d overlay %s' % (self._idx, c.title), 1)
+        log.debug('atlas - publishers %s' % pubs, 2)
+        sched = atlas_prepare_schedule(sched, pubs)
+
+      # Resolve brands/series
+      resolve_content(sched)
+
+      # Process into EPG (for every channel sharing the schedule)
       log.debug('atlas - data thread %3d store   %s' % (self._idx, c.title), 1)
-      process_schedule(self._epg, c, sched)
+      bcs  = []
+      chns = [ c ] + self._inq.shared.get(id(c), [])
+      for chn in chns:
+        bcs.extend(process_schedule(chn, sched))
+      if not self._inq.store(self._epg, bcs):
+        log.debug('atlas - data thread %3d abandon %s' % (self._idx, c.title), 0)
+        break
+      stats.sample('atlas_channel_proc_time', time.time() - t)
+      if ATLAS_COST:
+        ATLAS_COST.update(c, proc=time.time() - t)
+      stats.set('_atlas_last_processed', time.time())
 
       # Done
       self._inq.task_done()
+      if self._inq.progress:
+        self._inq.progress.update(processed=self._inq.share * len(chns))
 
     log.debug('atlas - data thread %3d complete' % self._idx, 0)
 
 #
 # Channel Queue
 #
+# Channels are expanded, as they reach the head of the queue, into their
+# individual schedule requests (channel, time chunk, publisher) which are
+# returned by get_unit() as (job, index). Requests waiting for a retry are
+# held separately and returned once due, ahead of any new requests. The
+# async engine schedules its own requests, taking whole jobs (get_job()).
+#
+# Note: unfinished tasks are still counted per channel
+#
 class ChannelQueue ( Queue ):
-  def __init__ ( self, channels ):
+  def __init__ ( self, channels, start, stop ):
     Queue.__init__(self)
+    (self._url, self._p_pubs, self._s_pubs) = atlas_schedule_conf()
+    self.stream    = conf.get('atlas_grab_stream', False)
+    self.raw       = ATLAS_POOL is not None
+    self.coverage  = conf.get('atlas_coverage_skip', False)
+    self.progress  = None
+    self.shared    = {} # id(channel) -> other channels sharing its schedule
+    self.chunks    = atlas_time_chunks(start, stop)
+    self.partial   = set()
+    self.cancelled = False
+    self._window   = atlas_time_window(start, stop)
+    self._units    = deque()
+    self._retry    = []
+    self._active   = set()
+    self._held     = 0
     for c in channels: self.put(c)
   def remain ( self ):
     return self.unfinished_tasks
 
+  # Create fetch job for channel
+  def job ( self, c ):
+    return atlas_grab_job(c, self._url, self.chunks, self._p_pubs,
+                          self._s_pubs, self._window)
+
+  # Take next channel and create its fetch job (None if none left), the
+  # job is active (see cancel) until finished
+  #
+  # Note: mutex must be held
+  def _start ( self ):
+    if self.cancelled or not self._qsize(): return None
+    job = self.job(self._get())
+    self._active.add(job)
+    log.debug('atlas - queue %s (%d requests)'
+              % (job.chn.title, len(job.urls)), 1)
+    return job
+
+  # Start next channel (None if none left)
+  def get_job ( self ):
+    with self.mutex:
+      return self._start()
+
+  # Channel fetch complete
+  def finished ( self, job ):
+    with self.mutex:
+      self._active.discard(job)
+      if job.partial: self.partial.add(job.chn)
+
+  # Cancel all outstanding requests, returns the jobs in progress
+  def cancel ( self ):
+    with self.mutex:
+      self.cancelled = True
+      self._units.clear()
+      self._retry = []
+      ret = list(self._active)
+      self._active.clear()
+      self.not_empty.notifyAll()
+    return ret
+
+  # Hold request until due
+  def retry ( self, unit, due ):
+    with self.mutex:
+      if self.cancelled: return
+      heapq.heappush(self._retry, (due, id(unit), unit))
+      self.not_empty.notify()
+
+  # Queue held requests that are still needed (count is the number that
+  # were held, needed or not)
+  def release ( self, job, need, count ):
+    with self.mutex:
+      self._held = self._held - count
+      if not self.cancelled:
+        for i in reversed(need):
+          self._units.appendleft((job, i))
+      self.not_empty.notifyAll()
+
+  # Get next request (None if none left)
+  #
+  # Note: a channel with no requests is returned as (job, None)
+  #
+  # Note: with atlas_coverage_skip only the lead request for each time
+  #       chunk is queued initially, see release()
+  def get_unit ( self ):
+    with self.mutex:
+      while True:
+        if self.cancelled: return None
+        now = time.time()
+        if self._retry and self._retry[0][0] <= now:
+          return heapq.heappop(self._retry)[2]
+        job = None
+        if not self._units: job = self._start()
+        if job:
+          if not job.urls: return (job, None)
+          units = range(len(job.urls))
+          if self.coverage and len(job.pubs) > 1:
+            units      = job.hold()
+            self._held = self._held + len(job.urls) - len(units)
+          for i in units:
+            self._units.append((job, i))
+        if self._units:
+          return self._units.popleft()
+        if not self._retry and not self._held:
+          return None
+        timeout = None
+        if self._retry: timeout = self._retry[0][0] - now
+        self.not_empty.wait(timeout)
+
 #
 # Data Queue
 #
@@ -741,30 +2015,82 @@ class ChannelQueue ( Queue ):
 # return immediately with a new value OR raise empty (even if a wait is
 # specified)
 #
+# The queue can also be bounded, by number of items and/or total size
+# (of the responses the items were decoded from), in which case put()
+# blocks until the data threads have made room. A single item is always
+# accepted into an empty queue, however large.
+#
+# Once abandoned (see grab) the data threads can no longer add to the EPG,
+# any still running are left to exit in their own time.
+#
 class DataQueue ( Queue ):
 
-  def __init__ ( self, count ):
+  def __init__ ( self, count, items = 0, bytes = 0 ):
     Queue.__init__(self)
-    self._count = count
-    self._cond  = Condition()
+    self._count     = count
+    self._cond      = Condition()
+    self._space     = Condition()
+    self._max_items = items
+    self._max_bytes = bytes
+    self._items     = 0
+    self._bytes     = 0
+    self.progress   = None
+    self.share      = 1.0 # of a (fetched) channel per item
+    self.shared     = {}  # id(channel) -> other channels sharing its schedule
+    self.abandoned  = False
+    self._store     = Lock()
 
   def get ( self, block = True, timeout = None ):
     self._cond.acquire()
     if self.empty():
       if not self._count:
+        self._cond.release()
         raise Empty()
       elif block:
+        t = time.time()
         self._cond.wait(timeout)
+        stats.sample('atlas_dataq_get_wait', time.time() - t)
         if self.empty() and not self._count:
           self._cond.release()
           raise Empty()
     self._cond.release()
-    return Queue.get(self, block, timeout)
+    (size, data) = Queue.get(self, block, timeout)
+
+    # Release space
+    with self._space:
+      self._items = self._items - 1
+      self._bytes = self._bytes - size
+      self._space.notifyAll()
+    return data
+
+  # Queue is too full for new item
+  def _full ( self, size ):
+    if not self._items: return False
+    if self._max_items and self._items >= self._max_items: return True
+    if self._max_bytes and (self._bytes + size) > self._max_bytes: return True
+    return False
+
+  # Note: item is queued before the count is reduced so that remain()
+  #       never (briefly) reports zero while it's in flight
+  def put ( self, data, size = 0 ):
+
+    # Wait for space
+    with self._space:
+      if self._full(size):
+        t = time.time()
+        while self._full(size):
+          self._space.wait()
+        stats.sample('atlas_dataq_put_wait', time.time() - t)
+      self._items = self._items + 1
+      self._bytes = self._bytes + size
+      stats.sample('atlas_dataq_depth', self._items)
+      stats.sample('atlas_dataq_bytes', self._bytes)
 
-  def put ( self, data ):
+    # Add
     self._cond.acquire()
-    self._count = self._count - 1
-    Queue.put(self, data)
+    Queue.put(self, (size, data))
+    if self._count > 0:
+      self._count = self._count - 1
     if self._count:
       self._cond.notify()
     else:
@@ -774,6 +2100,25 @@ class DataQueue ( Queue ):
   def remain ( self ):
     return self._count + self.unfinished_tasks
 
+  # No more items will be added (data threads exit once queue is empty)
+  def close ( self ):
+    with self._cond:
+      self._count = 0
+      self._cond.notifyAll()
+
+  # Add broadcasts to the EPG, returns False if abandoned
+  def store ( self, epg, bcs ):
+    with self._store:
+      if self.abandoned: return False
+      for b in bcs: epg.add_broadcast(b)
+      return True
+
+  # No further changes to the EPG (waits for any in progress)
+  def abandon ( self ):
+    self.close()
+    with self._store:
+      self.abandoned = True
+
 # ###########################################################################
 # Grabber API
 # ###########################################################################
@@ -781,6 +2126,7 @@ class DataQueue ( Queue ):
 # Grab specified data
 def grab ( epg, channels, start, stop ):
   import multiprocessing as mp
+  global ATLAS_COST, ATLAS_POOL, ATLAS_DEADLINE, CONTENT_MISSING
 
   # Filter the channel list (only include those we have listing for)
   channels = filter_channels(channels)
@@ -788,6 +2134,14 @@ def grab ( epg, channels, start, stop ):
   channels = sorted(channels, cmp=lambda a,b: cmp(a.number,b.number))
   log.info('atlas - epg grab %d channels for %d days' % (len(channels), days))
 
+  # Channels sharing a schedule are fetched once
+  allchns            = channels
+  (channels, shared) = atlas_shared_channels(channels)
+  if shared:
+    n = len(allchns) - len(channels)
+    log.info('atlas - %d channels share a schedule with another' % n)
+    stats.set('atlas_channels_shared', n)
+
   # Config
   grab_thread_cnt = conf.get('atlas_grab_threads', 32)
   data_thread_cnt = conf.get('atlas_data_threads', 0)
@@ -798,15 +2152,59 @@ def grab ( epg, channels, start, stop ):
   data_thread_cnt = min(data_thread_cnt, len(channels))
   grab_thread_cnt = min(grab_thread_cnt, len(channels))
 
-  # Create input/output queues
-  inq  = ChannelQueue(channels)
-  outq = DataQueue(len(channels))
+  # Expire old schedule responses
+  cache.url_cache_prune('atlas/schedule',
+                        conf.get('atlas_sched_cache_prune', 7 * 86400))
+
+  # Order channels (most expensive first)
+  ATLAS_COST = CostModel()
+  if conf.get('atlas_grab_order', 'cost') == 'cost':
+    channels = ATLAS_COST.order(channels)
+
+  # Unresolved brands/series (not carried over when replaying)
+  if archive.replaying():
+    CONTENT_MISSING = MissingContent(None)
+  else:
+    CONTENT_MISSING = MissingContent()
+
+  # Create data worker processes (before any threads are started)
+  data_proc_cnt = conf.get('atlas_data_procs', 0)
+  if data_proc_cnt < 0:
+    data_proc_cnt = mp.cpu_count()
+  if data_proc_cnt:
+    log.info('atlas - using %d data processes' % data_proc_cnt)
+    ATLAS_POOL = mp.Pool(data_proc_cnt)
+    data_thread_cnt = max(data_thread_cnt, data_proc_cnt)
+
+  # Create input/output queues (streaming passes on each time chunk)
+  inq  = ChannelQueue(channels, start, stop)
+  outn = len(channels)
+  outu = 'channels'
+  if inq.stream:
+    outn = len(channels) * len(inq.chunks)
+    outu = 'chunks'
+  outq = DataQueue(outn, conf.get('atlas_data_queue_items', 0),
+                   conf.get('atlas_data_queue_bytes', 0))
+  prog = progress.Progress('atlas', len(allchns))
+  inq.progress = outq.progress = prog
+  inq.shared   = outq.shared = shared
+  if outn: outq.share = float(len(channels)) / outn
 
   # Create grab threads
   grab_threads = []
-  for i in range(grab_thread_cnt):
-    t = GrabThread(i, inq, outq, start, stop)
-    grab_threads.append(t)
+  engine       = conf.get('atlas_grab_engine', 'thread')
+  if engine == 'async' and archive.replaying():
+    log.info('atlas - replaying archive, using thread engine')
+    engine = 'thread'
+  if engine == 'async':
+    grab_threads.append(AsyncGrabThread(0, inq, outq, start, stop))
+    workers = conf.get('atlas_async_conns', 64)\
+            * conf.get('atlas_async_pipeline', 4)
+  else:
+    workers = grab_thread_cnt
+    for i in range(grab_thread_cnt):
+      t = GrabThread(i, inq, outq, start, stop)
+      grab_threads.append(t)
 
   # Create data threads
   data_threads = []
@@ -815,36 +2213,154 @@ def grab ( epg, channels, start, stop ):
     data_threads.append(t)
 
   # Start threads
+  predict = ATLAS_COST.makespan(channels, workers)
+  t0      = time.time()
+  ATLAS_DEADLINE = None
+  if float(conf.get('grab_deadline', 0)) > 0:
+    ATLAS_DEADLINE = t0 + float(conf.get('grab_deadline'))
   for t in grab_threads: t.start()
   for t in data_threads: t.start()
 
   # Wait for completion (inq first)
-  ins = outs = len(channels)
+  #
+  # Note: woken on every progress update and thread exit, the remaining
+  #       counts are only logged once a second (and at the end)
+  #
+  # Once the deadline passes all outstanding requests are cancelled (and
+  # those in progress interrupted), what has been fetched is processed
+  # (allowing grab_deadline_grace seconds) and the rest abandoned. The
+  # deadline stays in force, so no retries are made, until every thread
+  # has exited
+  #
+  # Pooled connections with a request outstanding for longer than
+  # atlas_fetch_budget are reaped, the request fails and is retried like
+  # any other (the async engine's own connections are checked by the
+  # engine itself)
+  ins    = len(channels)
+  outs   = outn
+  last   = 0
+  grace  = None
+  budget = float(conf.get('atlas_fetch_budget', 120.0))
+  reap   = None
+  if budget > 0:
+    reap = t0 + budget / 4
   while True:
-    s = inq.remain()
-    if s != ins:
-      ins = s
-      log.info('atlas - grab %3d/%3d channels remain' % (s, len(channels)))
-    s = outq.remain()
-    if s != outs:
-      outs = s
-      log.info('atlas - proc %3d/%3d channels remain' % (s, len(channels)))
-    if not ins and not outs: break
-  
+    seq   = prog.seq
+    now   = time.time()
+
+    # Watchdog
+    if reap and now >= reap:
+      n = httppool.reap(budget)
+      if n:
+        log.warn('atlas - reaped %d requests exceeding %0.1fs' % (n, budget))
+        stats.inc('atlas_reaped', n)
+      reap = now + budget / 4
+
+    # Deadline
+    if ATLAS_DEADLINE and now >= ATLAS_DEADLINE and grace is None:
+      log.warn('atlas - grab deadline reached, cancelling outstanding requests')
+      stats.inc('atlas_deadline_expired')
+      for job in inq.cancel():
+        if job.cancel(): atlas_grab_partial(job, inq, outq)
+      outq.close()
+      httppool.reap(0)
+      grace = now + float(conf.get('grab_deadline_grace', 30))
+    if grace is not None and now >= grace:
+      log.error('atlas - grab deadline grace expired, abandoning processing')
+      break
+
+    rins  = inq.remain()
+    routs = outq.remain()
+    if grace is not None: rins = 0
+    if (now - last) >= 1.0 or not (rins or routs):
+      if rins != ins:
+        ins  = rins
+        last = now
+        log.info('atlas - grab %3d/%3d channels remain' % (ins, len(channels)))
+      if routs != outs:
+        outs = routs
+        last = now
+        log.info('atlas - proc %3d/%3d %s remain' % (outs, outn, outu))
+    if not rins and not routs: break
+
     # Safety checks
+    #
+    # Note: the remaining counts are checked again, the last thread may
+    #       have completed its work (and exited) since they were read
     i = 0
     for t in grab_threads:
-      if t.isAlive(): i = i + 1
-    if not i and ins:
+      if not t.done: i = i + 1
+    if not i and rins and inq.remain():
       log.error('atlas - grab threads have died prematurely')
       break
     i = 0
     for t in data_threads:
-      if t.isAlive(): i = i + 1
-    if not i and outs:
+      if not t.done: i = i + 1
+    if not i and routs and outq.remain():
       log.error('atlas - proc threads have died prematurely')
       break
-    time.sleep(1.0)
+
+    # Wait for next event (or to log pending changes, the deadline or the
+    # next watchdog check)
+    timeout = None
+    if rins != ins or routs != outs:
+      timeout = max(0.0, last + 1.0 - now)
+    for t in [ ATLAS_DEADLINE, grace, reap ]:
+      if t and t > now and (timeout is None or (t - now) < timeout):
+        timeout = t - now
+    prog.wait(seq, timeout)
+
+  # Abandon any threads still running
+  outq.abandon()
+  i = len(filter(lambda t: not t.done, grab_threads + data_threads))
+  if i:
+    log.warn('atlas - %d threads abandoned' % i)
+    httppool.reap(0)
+  else:
+    ATLAS_DEADLINE = None
+
+  # Missing/partial channels
+  got     = set(epg.get_channels())
+  missing = filter(lambda c: c not in got, allchns)
+  partial = []
+  for c in inq.partial:
+    partial.extend(filter(lambda x: x in got, [ c ] + shared.get(id(c), [])))
+  for (k, cs) in [ ('missing', missing), ('partial', partial) ]:
+    if not cs: continue
+    t = ', '.join(sorted(map(lambda c: c.title or c.uri, cs)))
+    log.warn('atlas - %d channels %s: %s' % (len(cs), k, t))
+    stats.set('atlas_channels_%s' % k, len(cs))
+    stats.set('atlas_channels_%s_list' % k, t)
+
+  # Coverage
+  if inq.coverage:
+    log.info('atlas - %d requests skipped (covered by lead publisher)'\
+             % stats.get('atlas_requests_skipped'))
+
+  # Stop worker processes
+  if ATLAS_POOL:
+    if grace is not None:
+      ATLAS_POOL.terminate()
+    else:
+      ATLAS_POOL.close()
+    ATLAS_POOL.join()
+    ATLAS_POOL = None
+
+  # Makespan
+  actual = stats.get('_atlas_last_processed', time.time()) - t0
+  stats.set('atlas_makespan', actual)
+  if predict is not None:
+    stats.set('atlas_makespan_predicted', predict)
+    log.info('atlas - makespan %0.1fs (predicted %0.1fs)' % (actual, predict))
+
+  # Unresolved brands/series
+  CONTENT_MISSING.report(conf.get('atlas_content_missing_report', 10))
+
+  # Update cost history (replayed timings are not representative) and
+  # unresolved content
+  if not archive.replaying():
+    ATLAS_COST.save()
+    CONTENT_MISSING.save()
 
 # Get a list of the support packages
 def packages ():
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# pyepg/httppool.py - Persistent HTTP connection pool
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Process wide pool of keep-alive HTTP connections, keyed by host. Idle
+connections are checked before re-use and replaced if the server has
+closed them.
+
+Connections have separate connect and read (per socket operation)
+timeouts. A server trickling data can still hold a request for much longer
+than the read timeout, so in-use connections can also be reaped (shut down
+under the caller, whose request then fails) once they exceed a latency
+budget, see reap().
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import time, select, socket, httplib
+from threading import Condition, Lock
+
+# PyEPG
+import pyepg.conf  as conf
+import pyepg.log   as log
+import pyepg.stats as stats
+
+# ###########################################################################
+# Pool
+# ###########################################################################
+
+class Pool:
+
+  def __init__ ( self, limit = 32, idle = 30.0, timeout = 60.0,
+                 connect = None ):
+    self._limit   = limit
+    self._idle    = idle
+    self._timeout = timeout
+    self._connect = connect or timeout
+    self._cond  = Condition()
+    self._free  = {} # key -> [ (conn, last used) ]
+    self._used  = {} # key -> count
+    self._busy  = {} # conn -> acquired
+
+  # Check idle connection is still usable
+  def _alive ( self, conn, used ):
+    if (time.time() - used) > self._idle: return False
+    if conn.sock is None: return False
+
+    # Readable idle socket means EOF (or junk) from the server
+    try:
+      (r, w, e) = select.select([conn.sock], [], [], 0)
+      return not r
+    except Exception:
+      return False
+
+  # Get a connection
+  def acquire ( self, scheme, host ):
+    key = (scheme, host)
+    with self._cond:
+      while True:
+
+        # Re-use idle connection
+        free = self._free.get(key, [])
+        while free:
+          (conn, used) = free.pop()
+          if self._alive(conn, used):
+            self._used[key] = self._used.get(key, 0) + 1
+            stats.inc('http_conn_reused')
+            conn._pyepg_reused = True
+            self._busy[conn]   = time.time()
+            return conn
+          log.debug('httppool - discard dead conn to %s' % host, 3)
+          stats.inc('http_conn_dead')
+          conn.close()
+
+        # Create new
+        if not self._limit or self._used.get(key, 0) < self._limit:
+          self._used[key] = self._used.get(key, 0) + 1
+          break
+
+        # Wait for one to be released
+        stats.inc('http_conn_waits')
+        self._cond.wait()
+
+    # Connect (outside of lock)
+    log.debug('httppool - new conn to %s://%s' % key, 3)
+    stats.inc('http_conn_created')
+    if scheme == 'https':
+      conn = httplib.HTTPSConnection(host, timeout=self._connect)
+    else:
+      conn = httplib.HTTPConnection(host, timeout=self._connect)
+    conn._pyepg_key    = key
+    conn._pyepg_reused = False
+    conn._pyepg_reaped = False
+    try:
+      conn.connect()
+      conn.sock.settimeout(self._timeout)
+    except Exception:
+      stats.inc('http_conn_failed')
+      conn.close()
+      with self._cond:
+        self._used[key] = self._used.get(key, 1) - 1
+        self._cond.notify()
+      raise
+    with self._cond:
+      self._busy[conn] = time.time()
+    return conn
+
+  # Return a connection (reuse=False will close it)
+  def release ( self, conn, reuse = True ):
+    key = conn._pyepg_key
+    with self._cond:
+      self._used[key] = self._used.get(key, 1) - 1
+      self._busy.pop(conn, None)
+      if reuse and conn.sock is not None and not conn._pyepg_reaped:
+        self._free.setdefault(key, []).append((conn, time.time()))
+      else:
+        conn.close()
+      self._cond.notify()
+
+  # Shut down connections that have been in use for longer than budget,
+  # the request on them fails and the connection is closed on release
+  #
+  # @return number of connections reaped
+  def reap ( self, budget ):
+    ret = 0
+    now = time.time()
+    with self._cond:
+      for conn in self._busy.keys():
+        if conn._pyepg_reaped or (now - self._busy[conn]) < budget: continue
+        log.debug('httppool - reap conn to %s://%s (busy %0.1fs)'\
+                  % (conn._pyepg_key + (now - self._busy[conn],)), 1)
+        conn._pyepg_reaped = True
+        try:
+          conn.sock.shutdown(socket.SHUT_RDWR)
+        except Exception: pass
+        stats.inc('http_conn_reaped')
+        ret = ret + 1
+    return ret
+
+  # Close all idle connections
+  def close ( self ):
+    with self._cond:
+      for k in self._free:
+        for (conn, used) in self._free[k]:
+          conn.close()
+      self._free = {}
+
+# ###########################################################################
+# API
+# ###########################################################################
+
+POOL      = None
+POOL_LOCK = Lock()
+
+# Get global pool
+def pool ():
+  global POOL
+  with POOL_LOCK:
+    if POOL is None:
+      POOL = Pool(conf.get('http_pool_host_limit', 32),
+                  conf.get('http_pool_idle_timeout', 30.0),
+                  conf.get('http_timeout', 60.0),
+                  conf.get('http_connect_timeout', 10.0))
+  return POOL
+
+# Get a connection
+def acquire ( scheme, host ):
+  return pool().acquire(scheme, host)
+
+# Return a connection
+def release ( conn, reuse = True ):
+  pool().release(conn, reuse)
+
+# Reap connections in use for longer than budget
+def reap ( budget ):
+  return pool().reap(budget)
+
+# ###########################################################################
+# Editor
+# ###########################################################################
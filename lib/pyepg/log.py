@@ -96,9 +96,13 @@ def out ( pre, msg, **dargs ):
         syslog.syslog(pri, msg)
       except: pass
 
+# Debug level enabled (to skip building messages that would be discarded)
+def debug_enabled ( lvl=0 ):
+  return LOG_DEBUG is not None and lvl <= LOG_DEBUG
+
 # Debug
 def debug ( msg, lvl=0, **dargs ):
-  if LOG_DEBUG is not None and lvl <= LOG_DEBUG:
+  if debug_enabled(lvl):
     out('DEBUG', msg, **dargs)
 
 # Info
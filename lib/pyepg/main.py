@@ -24,14 +24,17 @@
 # ###########################################################################
 
 # System
-import os, sys, datetime
+import os, sys, time, datetime
 
 # PyEPG
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
 import pyepg.log             as log
 import pyepg.conf            as conf
 import pyepg.cache           as cache
-from pyepg.model import EPG, Channel
+import pyepg.stats           as stats
+import pyepg.archive         as archive
+import pyepg.progress        as progress
+from pyepg.model import EPG, Channel, ShiftedBroadcast
 
 # ###########################################################################
 # Helpers
@@ -43,6 +46,18 @@ from pyepg.model import EPG, Channel
 def _import ( fmt, n ):
   return __import__(fmt % n, globals(), locals(), [n])
 
+#
+# Deadline (seconds or HH:MM) as seconds from now
+#
+def _deadline ( val ):
+  if ':' not in val:
+    return float(val)
+  (h, m) = map(int, val.split(':'))
+  now = datetime.datetime.now()
+  ret = now.replace(hour=h, minute=m, second=0, microsecond=0)
+  if ret <= now: ret = ret + datetime.timedelta(days=1)
+  return (ret - now).seconds + (ret - now).days * 86400
+
 #
 # Default Configuration options
 #
@@ -70,6 +85,9 @@ def options ( name = None ):
   optg = OptionGroup(optp, 'Generic Grab Options', '')
   optg.add_option('-d', '--days', default=None, type='int',
                   help='specify the number of days to grab')
+  optg.add_option('--deadline', default=None, type='string',
+                  help='finish the grab (with partial results) after the '
+                       'given seconds or at HH:MM')
   if name not in [ 'tv_grab_pyepg' ]:
     optg.add_option('-f', '--formatter', default=None,
                     help='specify the output format')
@@ -104,6 +122,10 @@ def options ( name = None ):
                   help='specify log path to write to')
   optg.add_option('--syslog', default=False, action='store_true',
                   help='specify logging should go to syslog')
+  optg.add_option('--record', default=None, type='string',
+                  help='record all HTTP traffic to archive file')
+  optg.add_option('--replay', default=None, type='string',
+                  help='replay HTTP traffic from archive file (no network)')
   optp.add_option_group(optg)
 
   # Return parser
@@ -124,6 +146,8 @@ def setup ( opts = {}, args = [], conf_path = None ):
         conf_over[p[0]] = p[1]
   if hasattr(opts, 'days') and opts.days is not None:
     conf_over['days'] = opts.days
+  if hasattr(opts, 'deadline') and opts.deadline is not None:
+    conf_over['grab_deadline'] = _deadline(opts.deadline)
   if hasattr(opts, 'formatter') and opts.formatter is not None:
     conf_over['formatter'] = opts.formatter
   if hasattr(opts, 'grabber') and opts.grabber is not None:
@@ -134,6 +158,12 @@ def setup ( opts = {}, args = [], conf_path = None ):
     conf_over['log_path'] = opts.logpath
   if hasattr(opts, 'syslog') and opts.syslog is not None:
     conf_over['syslog'] = opts.syslog
+  if hasattr(opts, 'record') and opts.record is not None:
+    conf_over['http_archive']      = opts.record
+    conf_over['http_archive_mode'] = 'record'
+  if hasattr(opts, 'replay') and opts.replay is not None:
+    conf_over['http_archive']      = opts.replay
+    conf_over['http_archive_mode'] = 'replay'
   if hasattr(opts, 'config') and opts.config is not None:
     conf_path = opts.config
   if hasattr(opts, 'confdir') and opts.confdir is not None:
@@ -156,6 +186,11 @@ def setup ( opts = {}, args = [], conf_path = None ):
   # Initialise the cache
   cache.init(cache_path) 
 
+  # Record/replay HTTP traffic
+  if conf.get('http_archive', None):
+    archive.init(conf.get('http_archive'),
+                 conf.get('http_archive_mode', 'replay'))
+
 #
 # Get current grabber
 #
@@ -222,40 +257,44 @@ def get_channels ( package = None ):
   return channels
 
 #
-# Fix missing plusN channels
+# Find plusN channels (uri ending +N) for which the base channel is also
+# being grabbed
 #
-def fix_plus_n ( epg, channels ):
+# @return [ (plusN channel, offset (hours), base channel) ]
+def find_plus_n ( channels ):
   import re
-  from copy     import copy
-  from datetime import timedelta
+  exp   = re.compile('(\+\d+)$')
+  index = {}
+  ret   = []
+  for c in channels:
+    if c.uri not in index: index[c.uri] = c
+  for c in channels:
+    r = exp.search(c.uri)
+    if r:
+      base = index.get(c.uri.replace(r.group(1), ''))
+      if base: ret.append((c, int(r.group(1)), base))
+  return ret
 
-  epg_chns = epg.get_channels()
-  exp      = re.compile('(\+\d+)$')
-  fix      = []
+#
+# Fix missing plusN channels (also those not grabbed, see plus_n_derive)
+#
+# Note: the plusN schedule is a shifted view of the base schedule, sharing
+#       its broadcast details and episodes
+#
+def fix_plus_n ( epg, channels ):
+  from datetime import timedelta
 
-  # Find potential candidates for a fix
-  for c in channels:
-    if c not in epg_chns:
-      r = exp.search(c.uri)
-      if r:
-        os  = int(r.group(1))
-        uri = c.uri.replace(r.group(1), '')
-        for c1 in channels:
-          if uri == c1.uri:
-            fix.append((c, os*60, c1))
-            break
+  epg_chns = set(epg.get_channels())
 
   # Fix the channels
-  for (plus, offset, base) in fix:
+  for (plus, offset, base) in find_plus_n(channels):
+    if plus in epg_chns: continue
     sched = epg.get_schedule(base)
     if not sched: continue
     log.info('pyepg - fix missing plusN channel %s' % plus.title)
+    offset = timedelta(hours=offset)
     for e in sched:
-      n         = copy(e)
-      n.channel = plus
-      n.start   = n.start + timedelta(minutes=offset)
-      n.stop    = n.stop  + timedelta(minutes=offset)
-      epg.add_broadcast(n)
+      epg.add_broadcast(ShiftedBroadcast(e, plus, offset))
 
 # Get select
 def get_select ( msg, options ):
@@ -313,6 +352,17 @@ def grab ( opts, args ):
   days     = conf.get('days', 7)
   today    = datetime.datetime.today()
 
+  # Record/replay the grab period (the schedule requests depend on it)
+  fmt      = '%Y-%m-%d %H:%M:%S.%f'
+  archive.set_meta('period', (today.strftime(fmt), days))
+  period   = archive.get_meta('period')
+  if period:
+    today  = datetime.datetime.strptime(period[0], fmt)
+    days   = period[1]
+    log.info('replaying grab from %s for %d days' % (today, days))
+  elif archive.replaying():
+    log.warn('archive has no grab period, requests may not match')
+
   # Get grabber/formatter
   grabber   = get_grabber()
   formatter = get_formatter()
@@ -320,9 +370,29 @@ def grab ( opts, args ):
   # Channels
   channels  = get_channels()
 
+  # PlusN channels can be derived from their base channel, rather than
+  # grabbed (see fix_plus_n)
+  fetch     = channels
+  if conf.get('plus_n_derive', False):
+    plus  = set(map(lambda x: id(x[0]), find_plus_n(channels)))
+    fetch = filter(lambda c: id(c) not in plus, channels)
+    log.info('deriving %d plusN channels from their base' % len(plus))
+
+  # Progress (logged every progress_interval seconds)
+  last = [ time.time() ]
+  def _progress ( p ):
+    now = time.time()
+    if (now - last[0]) >= conf.get('progress_interval', 10):
+      last[0] = now
+      log.info('progress - %s' % p)
+
   # Get EPG
   log.info('grabbing EPG for %d days' % days)
-  grabber.grab(epg, channels, today, today + datetime.timedelta(days=days))
+  progress.subscribe(_progress)
+  try:
+    grabber.grab(epg, fetch, today, today + datetime.timedelta(days=days))
+  finally:
+    progress.unsubscribe(_progress)
 
   # Attempt to deal with missing +N channels
   fix_plus_n(epg, channels)
@@ -342,6 +412,7 @@ def grab ( opts, args ):
   log.info('Series   Count: %d' % len(epg.get_series()))
   log.info('Episode  Count: %d' % len(epg.get_episodes()))
   log.info('Schedule Count: %d' % epg.get_sched_count())
+  stats.report()
 
 #
 # Configure the system
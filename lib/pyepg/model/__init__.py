@@ -2,7 +2,7 @@
 
 from epg       import EPG
 from channel   import Channel
-from broadcast import Broadcast
+from broadcast import Broadcast, ShiftedBroadcast
 from brand     import Brand
 from series    import Series
 from episode   import Episode
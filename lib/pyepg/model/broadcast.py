@@ -43,3 +43,32 @@ class Broadcast:
     if not ret:
       ret = cmp(self.start, self.stop)
     return ret
+
+#
+# View of a broadcast on another channel, shifted in time (e.g. for +N
+# channels). Everything else, including the Episode, is read from the base
+# broadcast. Anything set on the view applies only to the view.
+#
+class ShiftedBroadcast ( Broadcast, object ):
+
+  def __init__ ( self, base, channel, offset ):
+    self.base    = base
+    self.channel = channel
+    self.offset  = offset
+
+  def __getattr__ ( self, name ):
+    return getattr(self.__dict__['base'], name)
+
+  def _get_start ( self ):
+    if '_start' in self.__dict__: return self._start
+    return self.base.start + self.offset
+  def _set_start ( self, val ):
+    self._start = val
+  start = property(_get_start, _set_start)
+
+  def _get_stop ( self ):
+    if '_stop' in self.__dict__: return self._stop
+    return self.base.stop + self.offset
+  def _set_stop ( self, val ):
+    self._stop = val
+  stop = property(_get_stop, _set_stop)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# pyepg/progress.py - Grab progress reporting
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Grab progress, updated by the grabbers as channels are fetched and
+processed. Interested parties subscribe a callback, which is called (from
+the grabber's threads) with the Progress object on every update:
+
+  def cb ( p ):
+    print '%d/%d channels, eta %s' % (p.processed, p.total, p.eta())
+  progress.subscribe(cb)
+
+Grabbers can also wait() for the next update rather than polling.
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import time
+from threading import Condition, Lock
+
+# PyEPG
+import pyepg.log as log
+
+# ###########################################################################
+# Progress
+# ###########################################################################
+
+class Progress:
+
+  def __init__ ( self, name, total ):
+    self.name      = name
+    self.total     = total
+    self.fetched   = 0
+    self.processed = 0
+    self.bytes     = 0
+    self.started   = time.time()
+    self.seq       = 0
+    self._cond     = Condition()
+
+  # Seconds since start
+  def elapsed ( self ):
+    return time.time() - self.started
+
+  # Estimated seconds remaining (None if unknown)
+  def eta ( self ):
+    if not self.processed: return None
+    rate = self.processed / self.elapsed()
+    return max(0.0, (self.total - self.processed) / rate)
+
+  # Update counts (channels may be fractional, e.g. partly processed)
+  def update ( self, fetched = 0, processed = 0, bytes = 0 ):
+    with self._cond:
+      self.fetched   = self.fetched   + fetched
+      self.processed = self.processed + processed
+      self.bytes     = self.bytes     + bytes
+      self.seq       = self.seq + 1
+      self._cond.notifyAll()
+    notify(self)
+
+  # Wake waiters (without any change in counts, e.g. thread exit)
+  def wake ( self ):
+    with self._cond:
+      self.seq = self.seq + 1
+      self._cond.notifyAll()
+
+  # Wait for next update after seq (or timeout), returns current seq
+  def wait ( self, seq, timeout = None ):
+    with self._cond:
+      if self.seq == seq:
+        self._cond.wait(timeout)
+      return self.seq
+
+  def __str__ ( self ):
+    ret = '%s %d/%d fetched, %0.1f/%d processed, %0.1fMB'\
+        % (self.name, self.fetched, self.total, self.processed, self.total,
+           self.bytes / 1048576.0)
+    eta = self.eta()
+    if eta is not None: ret = ret + ', eta %ds' % eta
+    return ret
+
+# ###########################################################################
+# Callbacks
+# ###########################################################################
+
+CALLBACKS      = []
+CALLBACKS_LOCK = Lock()
+
+# Add callback
+def subscribe ( cb ):
+  with CALLBACKS_LOCK:
+    if cb not in CALLBACKS: CALLBACKS.append(cb)
+
+# Remove callback
+def unsubscribe ( cb ):
+  with CALLBACKS_LOCK:
+    if cb in CALLBACKS: CALLBACKS.remove(cb)
+
+# Call subscribers (errors are logged, not propagated to the grabber)
+def notify ( p ):
+  with CALLBACKS_LOCK:
+    cbs = list(CALLBACKS)
+  for cb in cbs:
+    try:
+      cb(p)
+    except Exception, e:
+      log.error('progress callback failed [e=%s]' % e)
+
+# ###########################################################################
+# Editor
+# ###########################################################################
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# pyepg/stats.py - Runtime statistics
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Thread safe counters, used to report on the internals of a grab
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+from threading import Lock
+
+# PyEPG
+import pyepg.log as log
+
+# ###########################################################################
+# Data
+# ###########################################################################
+
+STATS_LOCK = Lock()
+STATS_DATA = {}
+
+# ###########################################################################
+# Functions
+# ###########################################################################
+
+# Increment counter
+def inc ( key, val = 1 ):
+  with STATS_LOCK:
+    STATS_DATA[key] = STATS_DATA.get(key, 0) + val
+
+# Set value
+def set ( key, val ):
+  with STATS_LOCK:
+    STATS_DATA[key] = val
+
+# Get value
+def get ( key, default = 0 ):
+  with STATS_LOCK:
+    return STATS_DATA.get(key, default)
+
+# Add sample (value distributions, e.g. timings)
+def sample ( key, val ):
+  with STATS_LOCK:
+    if key not in STATS_DATA: STATS_DATA[key] = []
+    STATS_DATA[key].append(val)
+
+# Summarise samples, returns (count, mean, p50, p99, max)
+def summary ( vals ):
+  if not vals: return (0, 0, 0, 0, 0)
+  vals = sorted(vals)
+  n    = len(vals)
+  pct  = lambda p: vals[min(n - 1, int(p * n))]
+  return (n, sum(vals) / float(n), pct(0.50), pct(0.99), vals[-1])
+
+# Get all values (with optional key prefix)
+def all ( prefix = '' ):
+  ret = {}
+  with STATS_LOCK:
+    for k in STATS_DATA:
+      if k.startswith(prefix): ret[k] = STATS_DATA[k]
+  return ret
+
+# Reset
+def reset ():
+  with STATS_LOCK:
+    STATS_DATA.clear()
+
+# Output to log (keys starting _ are internal)
+def report ():
+  data = all()
+  keys = sorted(filter(lambda k: not k.startswith('_'), data.keys()))
+  if not keys: return
+  w    = max(map(len, keys))
+  for k in keys:
+    v = data[k]
+    if type(v) == list:
+      v = 'n=%d mean=%0.2f p50=%0.2f p99=%0.2f max=%0.2f' % summary(v)
+    elif type(v) == float:
+      v = '%0.2f' % v
+    log.info('%-*s: %s' % (w, k, v))
+
+# ###########################################################################
+# Editor
+# ###########################################################################
@@ -122,6 +122,9 @@ class TimeZoneSimple ( tzinfo ):
   def __cmp__ ( self, other ):
     return cmp(self.of, other.of)
 
+# UTC (shared, there's no need for an instance per datetime)
+UTC = TimeZoneSimple(0)
+
 #
 # Chunk an array into an array of smaller arrays
 #
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# tests/test_archive.py - HTTP record/replay archive tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for recording an archive and replaying requests from it
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, datetime, shutil, tempfile, unittest
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+import pyepg.conf    as conf
+import pyepg.archive as archive
+import pyepg.cache   as cache
+import pyepg.stats   as stats
+import pyepg.httppool as httppool
+import pyepg.emulator as emulator
+import pyepg.grabber.atlas as atlas
+from pyepg.model import EPG
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'data')
+
+# ###########################################################################
+# Tests
+# ###########################################################################
+
+URL = 'http://atlas/3.0/schedule.json?from=1&to=2&apiKey=%s&channel_id=c1'
+
+class ArchiveTest ( unittest.TestCase ):
+
+  def setUp ( self ):
+    conf.init(os.devnull, {})
+    self.dir  = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'test.arc')
+
+  def tearDown ( self ):
+    archive.ARCHIVE = None
+    shutil.rmtree(self.dir, True)
+
+  # Record a run, returns the archive (closed if close=True)
+  def record ( self, close = True ):
+    arc = archive.Archive(self.path, 'record')
+    arc.set_meta('period', ('2012-01-01 06:00:00.000000', 7))
+    arc.record('GET', URL % 'KEY1', 200, { 'etag' : '"1"' }, 'first', 0.5)
+    arc.record('GET', URL % 'KEY1', 503, {}, None, 0.1)
+    arc.record('GET', 'http://atlas/3.0/content.json?uri=x', 0, None, None,
+               1.0, 'timed out')
+    if close: arc.close()
+    return arc
+
+  def test_round_trip ( self ):
+    self.record()
+    arc = archive.Archive(self.path, 'replay')
+
+    # API key is not significant
+    r = arc.replay('GET', URL % 'KEY2')
+    self.assertEqual(r['status'], 200)
+    self.assertEqual(r['headers'], { 'etag' : '"1"' })
+    self.assertEqual(r['body'], 'first')
+    self.assertEqual(r['time'], 0.5)
+
+    # Repeats in recorded order, then the last is re-used
+    self.assertEqual(arc.replay('GET', URL % 'KEY2')['status'], 503)
+    self.assertEqual(arc.replay('GET', URL % 'KEY2')['status'], 503)
+
+    # Errors
+    r = arc.replay('GET', 'http://atlas/3.0/content.json?uri=x')
+    self.assertEqual(r['error'], 'timed out')
+
+    # Missing
+    self.assertEqual(arc.replay('GET', URL.replace('to=2', 'to=3') % ''),
+                     None)
+    self.assertEqual(arc.replay('HEAD', URL % 'KEY1'), None)
+    arc.close()
+
+  def test_meta ( self ):
+    self.record()
+    arc = archive.Archive(self.path, 'replay')
+    self.assertEqual(arc.get_meta('period'),
+                     ('2012-01-01 06:00:00.000000', 7))
+    self.assertEqual(arc.get_meta('other', 'x'), 'x')
+    arc.close()
+
+  # Interrupted recording (no index)
+  def test_rebuild_index ( self ):
+    arc = self.record(False)
+    arc._fp.close()
+    arc = archive.Archive(self.path, 'replay')
+    self.assertEqual(arc.replay('GET', URL % '')['body'], 'first')
+    self.assertEqual(arc.get_meta('period')[1], 7)
+    arc.close()
+
+  # Requests not in the archive fail, without retries
+  def test_replay_missing ( self ):
+    self.record()
+    archive.ARCHIVE = archive.Archive(self.path, 'replay')
+    self.assertEqual(cache._http_request(URL % 'KEY3')[2], 'first')
+    self.assertRaises(archive.ArchiveMissing, cache._http_request,
+                      URL.replace('c1', 'c2') % '')
+    try:
+      atlas.atlas_fetch_raw(URL.replace('c1', 'c2') % '')
+      self.fail('no error')
+    except atlas.AtlasFetchError, e:
+      self.assertFalse(e.retry)
+    archive.ARCHIVE.close()
+
+# Recording a grab (async engine)
+class RecordGrabTest ( unittest.TestCase ):
+
+  def setUp ( self ):
+    conf.CONF_DATA.clear()
+    conf.CONF_OVER.clear()
+    conf.init(os.devnull, {})
+    stats.reset()
+    self.dir  = tempfile.mkdtemp()
+    self.emu  = emulator.Emulator(data=DATA_PATH)
+    self.emu.start()
+    self.host = atlas.ATLAS_API_HOST
+    cache.init(os.path.join(self.dir, 'cache'))
+    atlas.ATLAS_API_HOST = self.emu.address()
+    conf.set('data_url', 'http://%s/data' % self.emu.address())
+
+  def tearDown ( self ):
+    archive.ARCHIVE      = None
+    atlas.ATLAS_API_HOST = self.host
+    httppool.pool().close()
+    self.emu.stop()
+    shutil.rmtree(self.dir, True)
+
+  # Each (compressed) response is only decoded once
+  def test_async ( self ):
+    conf.set('atlas_grab_engine', 'async')
+    path  = os.path.join(self.dir, 'grab.arc')
+    start = datetime.datetime.today().replace(hour=0, minute=0, second=0,
+                                              microsecond=0)
+    archive.ARCHIVE = archive.Archive(path, 'record')
+    chns = sorted(atlas.load_channels(), key=lambda c: c.uri)[:4]
+    atlas.grab(EPG(), chns, start, start + datetime.timedelta(days=1))
+    archive.ARCHIVE.close()
+    n = self.emu.counts()['requests']
+    self.assertEqual(stats.get('http_compressed_responses'), n)
+
+    # Recorded decoded
+    arc  = archive.Archive(path, 'replay')
+    keys = filter(lambda k: 'schedule.json' in k, arc._index)
+    self.assertTrue(keys)
+    for k in keys:
+      r = arc.replay(*k.split(' ', 1))
+      self.assertEqual(r['status'], 200)
+      self.assertFalse('content-encoding' in r['headers'])
+      self.assertTrue(r['body'].startswith('{'))
+    arc.close()
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# tests/test_asynchttp.py - Event driven HTTP client tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the incremental HTTP response parser and connect failures
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, socket, unittest
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+import pyepg.asynchttp as asynchttp
+
+# ###########################################################################
+# Parser
+# ###########################################################################
+
+# Feed data a byte at a time (every split point)
+def feed_bytes ( p, data ):
+  ret = []
+  for c in data:
+    ret.extend(p.feed(c))
+  return ret
+
+class ParserTest ( unittest.TestCase ):
+
+  def test_content_length ( self ):
+    p = asynchttp._Parser()
+    r = p.feed('HTTP/1.1 200 OK\r\nContent-Length: 5\r\nETag: "x"\r\n\r\nhello')
+    self.assertEqual(len(r), 1)
+    self.assertEqual(r[0].status, 200)
+    self.assertEqual(r[0].reason, 'OK')
+    self.assertEqual(r[0].headers['etag'], '"x"')
+    self.assertEqual(r[0].body, 'hello')
+    self.assertFalse(p.partial)
+
+  def test_content_length_split ( self ):
+    p = asynchttp._Parser()
+    r = feed_bytes(p, 'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+    self.assertEqual(map(lambda x: x.body, r), [ 'hello' ])
+
+  def test_chunked ( self ):
+    data = 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'\
+           '5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\n\r\n'
+    for f in [ lambda p, d: p.feed(d), feed_bytes ]:
+      p = asynchttp._Parser()
+      r = f(p, data)
+      self.assertEqual(len(r), 1)
+      self.assertEqual(r[0].body, 'hello, world')
+      self.assertFalse(p.partial)
+
+  def test_chunked_trailer ( self ):
+    p = asynchttp._Parser()
+    r = p.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+               '3\r\nabc\r\n0\r\nX-Trailer: 1\r\n\r\n')
+    self.assertEqual(r[0].body, 'abc')
+
+  def test_chunked_incomplete ( self ):
+    p = asynchttp._Parser()
+    r = p.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+               '5\r\nhel')
+    self.assertEqual(r, [])
+    self.assertTrue(p.partial)
+
+  def test_close_delimited ( self ):
+    p = asynchttp._Parser()
+    r = p.feed('HTTP/1.0 200 OK\r\n\r\nsome')
+    r = r + p.feed(' data')
+    self.assertEqual(r, [])
+    r = p.close()
+    self.assertEqual(r.version, 'HTTP/1.0')
+    self.assertEqual(r.body, 'some data')
+
+  def test_close_not_delimited ( self ):
+    p = asynchttp._Parser()
+    p.feed('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort')
+    self.assertEqual(p.close(), None)
+    self.assertTrue(p.partial)
+
+  def test_no_body ( self ):
+    p = asynchttp._Parser()
+    r = p.feed('HTTP/1.1 304 Not Modified\r\nETag: "x"\r\n\r\n'
+               'HTTP/1.1 204 No Content\r\n\r\n')
+    self.assertEqual(map(lambda x: (x.status, x.body), r),
+                     [ (304, ''), (204, '') ])
+
+  def test_pipelined ( self ):
+    data = 'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\na'\
+           'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'\
+           '1\r\nb\r\n0\r\n\r\n'\
+           'HTTP/1.1 404 Not Found\r\nContent-Length: 1\r\n\r\nc'
+    for f in [ lambda p, d: p.feed(d), feed_bytes ]:
+      p = asynchttp._Parser()
+      r = f(p, data)
+      self.assertEqual(map(lambda x: (x.status, x.body), r),
+                       [ (200, 'a'), (200, 'b'), (404, 'c') ])
+
+# ###########################################################################
+# Client
+# ###########################################################################
+
+class ClientTest ( unittest.TestCase ):
+
+  # A connection that can't be opened fails the queued requests (rather
+  # than raising out of poll) and holds off further attempts
+  def test_connect_failed ( self ):
+    res = []
+    c   = asynchttp.Client('127.0.0.1:1', conns=2)
+    c.addr = ('host.invalid', 1)
+    for i in range(3):
+      c.request(asynchttp.Request('http://host.invalid/%d' % i,
+                                  lambda req, resp, err: res.append((req, err))))
+    c.poll(0)
+    self.assertEqual(len(res), 3)
+    for (req, err) in res:
+      self.assertTrue(err.startswith('connect failed'))
+      self.assertTrue(req.sent is not None)
+    self.assertEqual(c.outstanding(), 0)
+    self.assertEqual(c._map, {})
+
+    # No new connection until the hold expires
+    c.request(asynchttp.Request('http://host.invalid/x',
+                                lambda req, resp, err: res.append((req, err))))
+    c.poll(0)
+    self.assertEqual(len(res), 3)
+    self.assertEqual(c.outstanding(), 1)
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+#
+# tests/test_atlas.py - Atlas grabber tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the Atlas grabber's supporting logic (no network access)
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, time, datetime, calendar, shutil, tempfile, unittest
+from threading import Thread, Event
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+import pyepg.conf  as conf
+import pyepg.cache as cache
+import pyepg.stats as stats
+import pyepg.httppool as httppool
+import pyepg.emulator as emulator
+import pyepg.grabber.atlas as atlas
+from pyepg.model import EPG, Channel
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'data')
+
+# ###########################################################################
+# Helpers
+# ###########################################################################
+
+class AtlasTestCase ( unittest.TestCase ):
+
+  def setUp ( self ):
+    conf.CONF_DATA.clear()
+    conf.CONF_OVER.clear()
+    conf.init(os.devnull, {})
+    self.path = tempfile.mkdtemp()
+    cache.init(self.path)
+    atlas.ATLAS_DEADLINE = None # left set if any threads were abandoned
+
+  def tearDown ( self ):
+    shutil.rmtree(self.path, True)
+
+# Channels c0, c1, ...
+def channels ( num ):
+  return map(lambda i: Channel('http://c/%d' % i), range(num))
+
+# ###########################################################################
+# Cost model
+# ###########################################################################
+
+class CostModelTest ( AtlasTestCase ):
+
+  def test_order ( self ):
+    cs = channels(4)
+    cm = atlas.CostModel()
+    self.assertEqual(cm.order(cs), cs)
+    self.assertEqual(cm.makespan(cs, 2), None)
+    for (c, t) in zip(cs, [ 1.0, 4.0, 2.0 ]):
+      cm.update(c, fetch=t)
+      cm.update(c, proc=t)
+    cm.save()
+
+    # Unknown channels are of average cost
+    cm = atlas.CostModel()
+    self.assertEqual(cm.cost(cs[1]), 8.0)
+    self.assertEqual(cm.cost(cs[3]), None)
+    self.assertEqual(cm.order(cs), [ cs[1], cs[3], cs[2], cs[0] ])
+
+    # Longest first over 2 workers: 8 + 2 | 4.67 + 4
+    self.assertAlmostEqual(cm.makespan(cm.order(cs), 2), 10.0)
+    self.assertAlmostEqual(cm.makespan(cs, 1), 14.0 + 14.0 / 3)
+
+  def test_blend ( self ):
+    conf.set('atlas_cost_weight', 0.25)
+    c  = channels(1)[0]
+    cm = atlas.CostModel()
+    cm.update(c, fetch=4.0)
+    cm.save()
+    cm.update(c, fetch=8.0)
+    cm.save()
+    self.assertEqual(atlas.CostModel().cost(c), 5.0)
+
+# ###########################################################################
+# Schedule cache
+# ###########################################################################
+
+class ScheduleCacheTest ( AtlasTestCase ):
+
+  # Cache entries for a grab starting at t
+  def names ( self, t ):
+    c = channels(1)[0]
+    c.shortid   = 'cbbh'
+    c.publisher = [ 'bbc.co.uk' ]
+    (url, p, s) = atlas.atlas_schedule_conf()
+    stop = t + datetime.timedelta(days=2)
+    job  = atlas.atlas_grab_job(c, url, atlas.atlas_time_chunks(t, stop), p, s)
+    return map(atlas.atlas_schedule_cache, job.urls)
+
+  # Re-runs (shortly after) only make the same requests when aligned
+  def test_aligned ( self ):
+    t0 = datetime.datetime(2012, 1, 1, 6, 0)
+    t1 = t0 + datetime.timedelta(minutes=10)
+    self.assertEqual(self.names(t0), [ None ] * 2)
+    conf.set('atlas_time_chunk', 86400)
+    conf.set('atlas_time_align', 3600)
+    n0 = self.names(t0)
+    self.assertEqual(len(n0), 6)
+    self.assertFalse(None in n0)
+    self.assertEqual(self.names(t1), n0)
+    conf.set('atlas_sched_cache', False)
+    self.assertEqual(self.names(t0), [ None ] * 6)
+
+# ###########################################################################
+# Coverage
+# ###########################################################################
+
+# Schedule entry (as returned by atlas), hours from 2012-01-01 06:00
+def entry ( pub, a, b, **fields ):
+  fmt = '2012-01-01T%02d:00:00Z'
+  ret = {
+    'uri'         : 'http://%s/%d' % (pub, a),
+    'title'       : 'Programme %d' % a,
+    'description' : 'About programme %d' % a,
+    'publisher'   : { 'key' : pub },
+    'genres'      : [ 'http://ref.atlasapi.org/genres/atlas/factual' ],
+    'people'      : [],
+    'broadcasts'  : [ {
+      'transmission_time'     : fmt % (6 + a),
+      'transmission_end_time' : fmt % (6 + b),
+      'repeat'                : False,
+      'subtitled'             : True,
+      'signed'                : False,
+      'audio_described'       : False,
+    } ],
+  }
+  ret.update(fields)
+  return ret
+
+class CoverageTest ( AtlasTestCase ):
+
+  def setUp ( self ):
+    AtlasTestCase.setUp(self)
+    stats.reset()
+    t   = datetime.datetime(2012, 1, 1, 6, 0)
+    tf  = calendar.timegm(t.timetuple())
+    c   = channels(1)[0]
+    c.shortid   = 'cbbh'
+    c.publisher = [ 'bbc.co.uk' ]
+    (url, p, s) = atlas.atlas_schedule_conf()
+    self.job = atlas.atlas_grab_job(c, url, [ (tf, tf + 3 * 3600) ], p, s)
+    self.assertEqual(self.job.pubs, [ 'pressassociation.com', 'bbc.co.uk' ])
+    self.assertEqual(self.job.hold(), [ 1 ])
+
+  # Lead (bbc) response for the chunk, returns (needed, skipped)
+  def lead ( self, items ):
+    self.job.done(1, items)
+    return atlas.atlas_grab_covered(self.job, 1)
+
+  def test_covered ( self ):
+    items = [ entry('bbc.co.uk', 0, 1, people=[ { 'name' : 'Presenter' } ]),
+              entry('bbc.co.uk', 1, 2, title='News', description=''),
+              entry('bbc.co.uk', 2, 3) ]
+    self.assertEqual(self.lead(items), ([], [ 0 ]))
+    self.assertEqual(stats.get('atlas_requests_skipped'), 1)
+
+  def test_gap ( self ):
+    items = [ entry('bbc.co.uk', 0, 1), entry('bbc.co.uk', 2, 3) ]
+    self.assertEqual(self.lead(items), ([ 0 ], []))
+
+  def test_short ( self ):
+    items = [ entry('bbc.co.uk', 0, 1), entry('bbc.co.uk', 1, 2) ]
+    self.assertEqual(self.lead(items), ([ 0 ], []))
+
+  def test_missing_field ( self ):
+    e = entry('bbc.co.uk', 1, 2)
+    del e['broadcasts'][0]['signed']
+    items = [ entry('bbc.co.uk', 0, 1), e, entry('bbc.co.uk', 2, 3) ]
+    self.assertEqual(self.lead(items), ([ 0 ], []))
+    self.assertEqual(stats.get('atlas_requests_skipped'), 0)
+
+  def test_fields ( self ):
+    conf.set('atlas_coverage_fields', [ 'title', 'year' ])
+    items = [ entry('bbc.co.uk', 0, 3) ]
+    self.assertEqual(self.lead(items), ([ 0 ], []))
+
+# ###########################################################################
+# In-flight lookups
+# ###########################################################################
+
+class SingleFlightTest ( AtlasTestCase ):
+
+  # Concurrent calls for the same key wait for (and share) the first
+  def test_collapse ( self ):
+    sf    = atlas.SingleFlight('test')
+    go    = Event()
+    calls = []
+    res   = []
+    def _get ():
+      calls.append(1)
+      go.wait()
+      return 'value'
+    n0 = stats.get('atlas_test_collapsed')
+    ts = map(lambda i: Thread(target=lambda: res.append(sf.do('k', _get))),
+             range(4))
+    for t in ts: t.start()
+    t = time.time() + 5
+    while stats.get('atlas_test_collapsed') - n0 < 3 and time.time() < t:
+      time.sleep(0.01)
+    go.set()
+    for t in ts: t.join(5)
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(res, [ 'value' ] * 4)
+    self.assertEqual(stats.get('atlas_test_collapsed') - n0, 3)
+
+    # Complete calls are not remembered
+    self.assertEqual(sf.do('k', lambda: 'again'), 'again')
+
+  def test_keys ( self ):
+    sf = atlas.SingleFlight('test')
+    self.assertEqual(sf.do('a', lambda: 1), 1)
+    self.assertEqual(sf.do('b', lambda: 2), 2)
+
+  def test_error ( self ):
+    sf = atlas.SingleFlight('test')
+    def _fail ():
+      raise ValueError('failed')
+    self.assertRaises(ValueError, sf.do, 'k', _fail)
+    self.assertEqual(sf.do('k', lambda: 'ok'), 'ok')
+
+# ###########################################################################
+# Unresolved content
+# ###########################################################################
+
+class MissingContentTest ( AtlasTestCase ):
+
+  def setUp ( self ):
+    AtlasTestCase.setUp(self)
+    self.fetch = atlas.atlas_fetch_content
+    self.once  = atlas.atlas_fetch_once
+    atlas.CONTENT_MISSING = atlas.MissingContent()
+
+  def tearDown ( self ):
+    atlas.atlas_fetch_content = self.fetch
+    atlas.atlas_fetch_once    = self.once
+    atlas.ATLAS_DEADLINE      = None
+    atlas.CONTENT_MISSING     = atlas.MissingContent(None)
+    AtlasTestCase.tearDown(self)
+
+  # Age entry by secs
+  def age ( self, mc, key, secs ):
+    mc._ents['%s %s' % (key[1], key[0])]['time'] -= secs
+
+  def test_ttl ( self ):
+    conf.set('atlas_content_missing_ttl', 100)
+    conf.set('atlas_content_failed_ttl',  10)
+    mc = atlas.MissingContent()
+    a  = ('http://b/a', 'brand')
+    b  = ('http://b/b', 'brand')
+    mc.add(a)
+    mc.add(b, True)
+    self.assertTrue(a in mc)
+    self.assertTrue(b in mc)
+    self.assertFalse(('http://b/a', 'series') in mc)
+    self.age(mc, a, 50)
+    self.age(mc, b, 50)
+    self.assertTrue(a in mc)
+    self.assertFalse(b in mc)
+    self.age(mc, a, 50)
+    self.assertFalse(a in mc)
+
+  # Only lookups skipped are counted (not membership checks)
+  def test_skip ( self ):
+    mc = atlas.MissingContent()
+    a  = ('http://b/a', 'brand')
+    self.assertFalse(mc.skip(a))
+    mc.add(a)
+    self.assertTrue(a in mc)
+    self.assertTrue(mc.skip(a))
+    self.assertTrue(mc.skip(a))
+    self.assertEqual(mc._hits, { 'brand http://b/a' : 2 })
+
+  # Persisted, without expired entries
+  def test_save ( self ):
+    conf.set('atlas_content_missing_ttl', 100)
+    mc = atlas.MissingContent()
+    a  = ('http://b/a', 'brand')
+    b  = ('http://s/b', 'series')
+    mc.add(a)
+    mc.add(b)
+    self.age(mc, b, 100)
+    mc.save()
+    mc = atlas.MissingContent()
+    self.assertTrue(a in mc)
+    self.assertEqual(mc._ents.keys(), [ 'brand http://b/a' ])
+    self.assertEqual(atlas.MissingContent(None)._ents, {})
+
+  # 404 means missing, other errors are failures
+  def test_get_content ( self ):
+    conf.set('atlas_content_missing_ttl', 100)
+    conf.set('atlas_content_failed_ttl',  10)
+    def _fetch ( code ):
+      def _f ( uri, key = None, errors = None ):
+        errors.append(atlas.atlas_http_error(code, 'Error', {}))
+        return None
+      return _f
+    for (code, ttl) in [ (404, 100), (500, 10) ]:
+      atlas.atlas_fetch_content = _fetch(code)
+      u = 'http://b/%d' % code
+      self.assertEqual(atlas.get_content(u, 'brand'), None)
+      self.assertEqual(atlas.CONTENT_MISSING._ents['brand ' + u]['ttl'], ttl)
+
+    # Not known to atlas
+    atlas.atlas_fetch_content = lambda u, key = None, errors = None:\
+      { 'contents' : [ { 'uri' : u, 'type' : 'series' } ] }
+    self.assertEqual(atlas.get_content('http://b/x', 'brand'), None)
+    self.assertEqual(atlas.CONTENT_MISSING._ents['brand http://b/x']['ttl'],
+                     100)
+
+    # Skipped
+    atlas.atlas_fetch_content = None
+    self.assertEqual(atlas.get_content('http://b/x', 'brand'), None)
+    self.assertEqual(atlas.CONTENT_MISSING._hits['brand http://b/x'], 1)
+
+  # Lookups cut short by the grab deadline are not recorded
+  def test_deadline ( self ):
+    def _fail ( url, conn = None ):
+      raise atlas.atlas_http_error(503, 'Service Unavailable', {})
+    atlas.atlas_fetch_once = _fail
+    a = ('http://b/d', 'brand')
+
+    # Retry would be after the deadline
+    atlas.ATLAS_DEADLINE = time.time() + 0.5
+    self.assertEqual(atlas.get_content(*a), None)
+    self.assertFalse(a in atlas.CONTENT_MISSING)
+
+    # Passed
+    atlas.ATLAS_DEADLINE = time.time()
+    errs = []
+    self.assertEqual(atlas.atlas_fetch_content(a[0], errors=errs), None)
+    self.assertTrue(isinstance(errs[0], atlas.AtlasDeadline))
+    self.assertEqual(atlas.get_content(*a), None)
+    self.assertFalse(a in atlas.CONTENT_MISSING)
+
+    # Retries exhausted
+    atlas.ATLAS_DEADLINE = None
+    conf.set('atlas_retry_limit', 1)
+    self.assertEqual(atlas.get_content(*a), None)
+    self.assertEqual(atlas.CONTENT_MISSING._ents['brand http://b/d']['ttl'],
+                     conf.get('atlas_content_failed_ttl', 3600))
+
+# ###########################################################################
+# Grab deadline
+# ###########################################################################
+
+class GrabDeadlineTest ( AtlasTestCase ):
+
+  def setUp ( self ):
+    AtlasTestCase.setUp(self)
+    stats.reset()
+    self.held  = Event()
+    self.emu   = emulator.Emulator(data=DATA_PATH)
+    self.emu.fault = self.fault
+    self.emu.start()
+    self.host  = atlas.ATLAS_API_HOST
+    self.start = datetime.datetime.today().replace(hour=0, minute=0,
+                                                   second=0, microsecond=0)
+    self.stop  = self.start + datetime.timedelta(days=2)
+    atlas.ATLAS_API_HOST = self.emu.address()
+    conf.set('data_url', 'http://%s/data' % self.emu.address())
+    conf.set('atlas_time_chunk', 86400)
+    conf.set('grab_deadline', 1.0)
+    self.first = atlas.atlas_time_chunks(self.start, self.stop)[0][0]
+
+  def tearDown ( self ):
+    atlas.ATLAS_API_HOST = self.host
+    self.held.set()
+    httppool.pool().close()
+    self.emu.stop()
+    AtlasTestCase.tearDown(self)
+
+  # Only the first day is fetched before the deadline (the rest are held
+  # until the test completes, then dropped)
+  def fault ( self, path ):
+    if 'schedule.json' in path and ('from=%d&' % self.first) not in path:
+      self.held.wait(10)
+      return ('hang', 0)
+    return None
+
+  # Every channel in progress is passed on with what has been fetched
+  def grab ( self, engine ):
+    conf.set('atlas_grab_engine', engine)
+    chns = sorted(atlas.load_channels(), key=lambda c: c.uri)[:6]
+    epg  = EPG()
+    atlas.grab(epg, chns, self.start, self.stop)
+    self.assertEqual(stats.get('atlas_deadline_expired'), 1)
+    self.assertEqual(stats.get('atlas_channels_missing'), 0)
+    self.assertEqual(stats.get('atlas_channels_partial'), 6)
+    self.assertEqual(len(epg.get_channels()), 6)
+
+  def test_thread ( self ):
+    self.grab('thread')
+
+  def test_async ( self ):
+    self.grab('async')
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################
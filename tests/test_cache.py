@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# tests/test_cache.py - Cache tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the file cache and cached (conditional) URL responses
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, shutil, tempfile, unittest
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+import pyepg.conf  as conf
+import pyepg.cache as cache
+
+# ###########################################################################
+# Tests
+# ###########################################################################
+
+class CacheTest ( unittest.TestCase ):
+
+  def setUp ( self ):
+    conf.init(os.devnull, {})
+    self.path = tempfile.mkdtemp()
+    cache.init(self.path)
+
+  def tearDown ( self ):
+    shutil.rmtree(self.path, True)
+
+  def test_put_get ( self ):
+    cache.put_file('a/b/c.json', 'data', { 'ETag' : '"x"' })
+    (data, meta, ok, valid) = cache._get_file('a/b/c.json', 0)
+    self.assertEqual(data, 'data')
+    self.assertEqual(meta['etag'], '"x"')
+    self.assertTrue(valid)
+
+  # Another thread creates the directory between the check and makedirs()
+  def test_put_dir_race ( self ):
+    exists = os.path.exists
+    try:
+      os.path.exists = lambda p: False
+      cache.put_file('a/one.json', '1')
+      cache.put_file('a/two.json', '2')
+    finally:
+      os.path.exists = exists
+    self.assertEqual(cache._get_file('a/two.json', 0)[0], '2')
+
+  def test_update_stores ( self ):
+    ret = cache.url_cache_update('u/x.json', 200, { 'etag' : '"1"' }, 'body')
+    self.assertEqual(ret, 'body')
+    (data, fresh, head) = cache.url_cache_lookup('u/x.json', 0)
+    self.assertEqual(data, 'body')
+    self.assertEqual(head, { 'If-None-Match' : '"1"' })
+
+  def test_update_not_modified ( self ):
+    ret = cache.url_cache_update('u/x.json', 304, {}, '', 'cached')
+    self.assertEqual(ret, 'cached')
+
+  # Failing to store the response doesn't fail the request
+  def test_update_store_failed ( self ):
+    open(os.path.join(self.path, 'file'), 'w').write('')
+    ret = cache.url_cache_update('file/x.json', 200, {}, 'body')
+    self.assertEqual(ret, 'body')
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# tests/test_httppool.py - HTTP connection pool tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the keep-alive connection pool (against a local socket that
+accepts connections and never responds)
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, socket, unittest
+from threading import Thread
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+import pyepg.httppool as httppool
+
+# ###########################################################################
+# Tests
+# ###########################################################################
+
+class PoolTest ( unittest.TestCase ):
+
+  def setUp ( self ):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(16)
+    self.host = '127.0.0.1:%d' % self.sock.getsockname()[1]
+
+  def tearDown ( self ):
+    self.sock.close()
+
+  def test_reuse ( self ):
+    p = httppool.Pool(2)
+    a = p.acquire('http', self.host)
+    self.assertFalse(a._pyepg_reused)
+    p.release(a)
+    b = p.acquire('http', self.host)
+    self.assertTrue(b is a)
+    self.assertTrue(b._pyepg_reused)
+
+    # Not reused
+    p.release(b, False)
+    self.assertEqual(b.sock, None)
+    c = p.acquire('http', self.host)
+    self.assertFalse(c is b)
+    p.release(c)
+    p.close()
+
+  # Idle connection closed by the server is discarded
+  def test_dead ( self ):
+    p = httppool.Pool(2)
+    a = p.acquire('http', self.host)
+    (s, addr) = self.sock.accept()
+    p.release(a)
+    s.close()
+    b = p.acquire('http', self.host)
+    self.assertFalse(b is a)
+    p.release(b)
+
+  # Acquire waits (at the per host limit) for a release
+  def test_limit ( self ):
+    p   = httppool.Pool(1)
+    a   = p.acquire('http', self.host)
+    res = []
+    t   = Thread(target=lambda: res.append(p.acquire('http', self.host)))
+    t.start()
+    t.join(0.2)
+    self.assertTrue(t.isAlive())
+    p.release(a)
+    t.join(5)
+    self.assertTrue(res[0] is a)
+    p.release(res[0])
+
+  def test_connect_failed ( self ):
+    p = httppool.Pool(1, connect=1.0)
+    self.assertRaises(Exception, p.acquire, 'http', 'host.invalid:1')
+    a = p.acquire('http', self.host)
+    p.release(a)
+
+  # Connections busy over budget are shutdown (and not re-used)
+  def test_reap ( self ):
+    p = httppool.Pool(2)
+    a = p.acquire('http', self.host)
+    (s, addr) = self.sock.accept()
+    self.assertEqual(p.reap(60), 0)
+    self.assertEqual(p.reap(0), 1)
+    self.assertTrue(a._pyepg_reaped)
+    self.assertEqual(s.recv(1), '')
+    self.assertEqual(p.reap(0), 0)
+    p.release(a)
+    self.assertEqual(a.sock, None)
+    b = p.acquire('http', self.host)
+    self.assertFalse(b is a)
+    p.release(b)
+    s.close()
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################
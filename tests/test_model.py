@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# tests/test_model.py - EPG model tests
+#
+# Copyright (C) 2012 Adam Sutton <dev@adamsutton.me.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Tests for the EPG model
+"""
+
+# ###########################################################################
+# Imports
+# ###########################################################################
+
+# System
+import os, sys, datetime, unittest
+
+# PyEPG
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'lib'))
+from pyepg.model import Channel, Episode, Broadcast, ShiftedBroadcast
+
+# ###########################################################################
+# Shifted broadcast
+# ###########################################################################
+
+class ShiftedBroadcastTest ( unittest.TestCase ):
+
+  def setUp ( self ):
+    self.chn  = Channel('http://c/1')
+    self.plus = Channel('http://c/1plus1')
+    self.base = Broadcast()
+    self.base.channel   = self.chn
+    self.base.episode   = Episode()
+    self.base.start     = datetime.datetime(2012, 1, 1, 20, 0)
+    self.base.stop      = datetime.datetime(2012, 1, 1, 21, 30)
+    self.base.subtitled = True
+    self.hour = datetime.timedelta(hours=1)
+
+  def test_shifted ( self ):
+    s = ShiftedBroadcast(self.base, self.plus, self.hour)
+    self.assertTrue(isinstance(s, Broadcast))
+    self.assertEqual(s.channel, self.plus)
+    self.assertEqual(s.start, datetime.datetime(2012, 1, 1, 21, 0))
+    self.assertEqual(s.stop,  datetime.datetime(2012, 1, 1, 22, 30))
+    self.assertTrue(s.episode is self.base.episode)
+    self.assertTrue(s.subtitled)
+
+  # Base changes (e.g. when the EPG is tidied) are seen through the view
+  def test_follows_base ( self ):
+    s = ShiftedBroadcast(self.base, self.plus, self.hour)
+    self.base.stop   = datetime.datetime(2012, 1, 1, 21, 0)
+    self.base.repeat = True
+    self.assertEqual(s.stop, datetime.datetime(2012, 1, 1, 22, 0))
+    self.assertTrue(s.repeat)
+
+  # Changes to the view are not seen in the base
+  def test_set_on_view ( self ):
+    s = ShiftedBroadcast(self.base, self.plus, self.hour)
+    s.stop       = datetime.datetime(2012, 1, 1, 22, 0)
+    s.followedby = Episode()
+    self.assertEqual(s.stop, datetime.datetime(2012, 1, 1, 22, 0))
+    self.assertEqual(self.base.stop, datetime.datetime(2012, 1, 1, 21, 30))
+    self.assertEqual(self.base.followedby, None)
+    self.assertEqual(self.base.channel, self.chn)
+
+  def test_negative_offset ( self ):
+    s = ShiftedBroadcast(self.base, self.plus, -self.hour)
+    self.assertEqual(s.start, datetime.datetime(2012, 1, 1, 19, 0))
+
+# ###########################################################################
+# Run
+# ###########################################################################
+
+if __name__ == '__main__':
+  unittest.main()
+
+# ############################################################################
+# Editor Configuration
+#
+# vim:sts=2:ts=2:sw=2:et
+# ############################################################################